@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+import tempfile
 import django_heroku
 import dj_database_url
 import pytz
@@ -124,8 +125,101 @@ USE_TZ = False
 
 STATIC_URL = '/webinterface/static/'
 
-# Connect to Heroku-PostgreSQL URL
-db_from_env = dj_database_url.config(conn_max_age=500, ssl_require=True)
+# Connect to Heroku-PostgreSQL URL. Connections are kept open between requests for DB_CONN_MAX_AGE seconds, but
+# are closed while a request waits on Nutritics (see utils.release_db_connection), so the number of connections in
+# use stays well below WEB_THREADS * web dynos
+db_from_env = dj_database_url.config(conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', 500)), ssl_require=True)
 DATABASES['default'].update(db_from_env)
 
 django_heroku.settings(locals())
+
+# Fingerprinted, precompressed static files served by WhiteNoise (set up by django_heroku) with far-future,
+# immutable cache headers. Only the hashed copies are kept in STATIC_ROOT (WhiteNoise 4+), with gzip and brotli copies
+STATICFILES_STORAGE = 'dashserver.storage.FingerprintedStaticFilesStorage'
+WHITENOISE_KEEP_ONLY_HASHED_FILES = True
+
+# In-process FoodCache memory cache (per worker)
+FOOD_MEMORY_CACHE_MAX_SIZE = int(os.environ.get('FOOD_MEMORY_CACHE_MAX_SIZE', 2048))
+FOOD_MEMORY_CACHE_TTL = int(os.environ.get('FOOD_MEMORY_CACHE_TTL', 3600))   # seconds
+
+# Cross-worker lease used so only one worker asks Nutritics about a given food at a time
+FOOD_LEASE_DIR = os.environ.get('FOOD_LEASE_DIR', os.path.join(tempfile.gettempdir(), 'dashserver-food-leases'))
+FOOD_LEASE_TIMEOUT = float(os.environ.get('FOOD_LEASE_TIMEOUT', 10))   # seconds
+
+# Nutritics HTTP client. NUTRITICS_BASE_URL can point at a stub server for load testing.
+# Each gunicorn thread (WEB_THREADS, see the Procfile) can have a lookup in flight, so the pool matches it
+NUTRITICS_BASE_URL = os.environ.get('NUTRITICS_BASE_URL')
+NUTRITICS_CONNECT_TIMEOUT = float(os.environ.get('NUTRITICS_CONNECT_TIMEOUT', 3.05))   # seconds
+NUTRITICS_READ_TIMEOUT = float(os.environ.get('NUTRITICS_READ_TIMEOUT', 10))   # seconds
+NUTRITICS_MAX_RETRIES = int(os.environ.get('NUTRITICS_MAX_RETRIES', 2))
+NUTRITICS_POOL_SIZE = int(os.environ.get('NUTRITICS_POOL_SIZE', os.environ.get('WEB_THREADS', 10)))
+NUTRITICS_BREAKER_THRESHOLD = int(os.environ.get('NUTRITICS_BREAKER_THRESHOLD', 5))
+NUTRITICS_BREAKER_RESET = float(os.environ.get('NUTRITICS_BREAKER_RESET', 30))   # seconds
+
+# Maximum number of concurrent Nutritics lookups made for a single batch of foods (e.g. create_meal)
+FOOD_LOOKUP_THREADS = int(os.environ.get('FOOD_LOOKUP_THREADS', 8))
+
+# Names Nutritics has no match for are remembered for this long, so they aren't searched for again
+FOOD_NEGATIVE_CACHE_MAX_SIZE = int(os.environ.get('FOOD_NEGATIVE_CACHE_MAX_SIZE', 4096))
+FOOD_NEGATIVE_CACHE_TTL = int(os.environ.get('FOOD_NEGATIVE_CACHE_TTL', 600))   # seconds
+
+# Bloom filter of known FoodCache IDs, used to skip database lookups for foods that definitely aren't cached
+FOOD_FILTER_CAPACITY = int(os.environ.get('FOOD_FILTER_CAPACITY', 100000))
+FOOD_FILTER_ERROR_RATE = float(os.environ.get('FOOD_FILTER_ERROR_RATE', 0.01))
+FOOD_FILTER_REFRESH = int(os.environ.get('FOOD_FILTER_REFRESH', 3600))   # seconds
+
+# Every worker logs its food cache hit / miss / false positive rates this often (0 turns it off)
+FOOD_CACHE_STATS_INTERVAL = int(os.environ.get('FOOD_CACHE_STATS_INTERVAL', 300))   # seconds
+
+# Optional memory-mapped nutrition table (see the build_nutrition_table command), checked before Nutritics
+NUTRITION_TABLE_PATH = os.environ.get('NUTRITION_TABLE_PATH')
+
+# FoodCache rows older than this are served as is, but refreshed from Nutritics in the background
+FOOD_STALE_AFTER_DAYS = int(os.environ.get('FOOD_STALE_AFTER_DAYS', 30))
+FOOD_REFRESH_PER_MINUTE = int(os.environ.get('FOOD_REFRESH_PER_MINUTE', 30))   # per worker
+FOOD_REFRESH_THREADS = int(os.environ.get('FOOD_REFRESH_THREADS', 2))
+
+# Short-lived per-worker cache of users and their goals, used by read-only REST handlers
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', 1024))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))   # seconds
+
+# Rendered insights pages are cached per worker, and revalidated against the user's data_version. Another worker's
+# changes to a user are noticed within USER_VERSION_TTL
+INSIGHTS_CACHE_MAX_SIZE = int(os.environ.get('INSIGHTS_CACHE_MAX_SIZE', 256))
+USER_VERSION_TTL = int(os.environ.get('USER_VERSION_TTL', 5))   # seconds
+
+# Live insights updates (server-sent events). Each open stream holds a gunicorn thread, and is closed after
+# INSIGHTS_STREAM_MAX_DURATION so the browser reconnects (and threads are freed) regularly
+INSIGHTS_STREAM_POLL = float(os.environ.get('INSIGHTS_STREAM_POLL', 5))   # seconds, for changes made by other workers
+INSIGHTS_STREAM_HEARTBEAT = float(os.environ.get('INSIGHTS_STREAM_HEARTBEAT', 15))   # seconds
+INSIGHTS_STREAM_MAX_DURATION = float(os.environ.get('INSIGHTS_STREAM_MAX_DURATION', 300))   # seconds
+# Streams open at once per worker. By default a quarter of the threads (see WEB_THREADS in the Procfile), so the
+# rest are always free for REST requests. Pages past the limit reload their data every INSIGHTS_STREAM_BUSY_RETRY
+INSIGHTS_MAX_STREAMS = int(os.environ.get('INSIGHTS_MAX_STREAMS', max(1, int(os.environ.get('WEB_THREADS', 8)) // 4)))
+INSIGHTS_STREAM_BUSY_RETRY = float(os.environ.get('INSIGHTS_STREAM_BUSY_RETRY', 30))   # seconds
+
+# Worker component (0-1022) of the time-ordered Entry IDs. Each process claims one of ENTRY_ID_WORKERS_PER_HOST slots
+# on its machine (with a lock file in ENTRY_ID_LOCK_DIR), added to ENTRY_ID_WORKER_BASE. The base defaults to a range
+# picked from the dyno's name (see utility.ids.default_worker_base()), so every process on up to 56 web dynos gets a
+# different worker ID, and one-off dynos never share one with a web dyno
+ENTRY_ID_WORKER_BASE = int(os.environ['ENTRY_ID_WORKER_BASE']) if 'ENTRY_ID_WORKER_BASE' in os.environ else None
+ENTRY_ID_WORKERS_PER_HOST = int(os.environ.get('ENTRY_ID_WORKERS_PER_HOST', 16))
+ENTRY_ID_LOCK_DIR = os.environ.get('ENTRY_ID_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'dashserver-entry-ids'))
+
+# How logged entries reach the database. "sync" writes them before responding. "buffered" appends them to a local
+# journal, responds straight away and writes them in batches from a background thread (see utility/writebehind.py).
+# Journals left by a crashed worker are replayed when the next worker starts. They're kept on the dyno's disk, which
+# Heroku wipes when a dyno restarts, so entries not yet flushed at a dyno restart (up to ENTRY_FLUSH_INTERVAL
+# seconds' worth) can be lost
+ENTRY_INGESTION_MODE = os.environ.get('ENTRY_INGESTION_MODE', 'sync')
+ENTRY_JOURNAL_DIR = os.environ.get('ENTRY_JOURNAL_DIR', os.path.join(tempfile.gettempdir(), 'dashserver-entry-journal'))
+ENTRY_FLUSH_INTERVAL = float(os.environ.get('ENTRY_FLUSH_INTERVAL', 1))   # seconds
+ENTRY_FLUSH_SIZE = int(os.environ.get('ENTRY_FLUSH_SIZE', 200))
+
+# Responses to logging requests sent with an idempotency key are replayed to retries for this long
+IDEMPOTENCY_CACHE_MAX_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_MAX_SIZE', 4096))   # per worker
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 3600))   # seconds
+# A retry that arrives while another worker is still handling the first request waits this long for its response,
+# then gets a 409. A request still being handled after IDEMPOTENCY_CLAIM_TIMEOUT is assumed to have died with its worker
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10))   # seconds
+IDEMPOTENCY_CLAIM_TIMEOUT = float(os.environ.get('IDEMPOTENCY_CLAIM_TIMEOUT', 60))   # seconds
@@ -0,0 +1,25 @@
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+"""
+Static file storage for collectstatic (the build step run on every Heroku deploy).
+"""
+
+
+class FingerprintedStaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """
+    Copies static files under names that include a hash of their contents (css/bootstrap.min.1a2b3c4d5e6f.css),
+    with gzip and, if the brotli package is installed, brotli compressed copies next to them. WhiteNoise serves
+    whichever copy the browser's Accept-Encoding allows, and marks hashed files immutable, so browsers cache
+    them for good and never revalidate them.
+
+    Django only puts the hashed names into {% static %} URLs when DEBUG is off. This storage always does, so the
+    deployed site (which runs with DEBUG on) gets them too. If collectstatic hasn't been run (e.g. with runserver)
+    the plain names are used instead.
+    """
+    manifest_strict = False
+
+    def url(self, name, force=False):
+        try:
+            return super().url(name, force=True)
+        except ValueError:
+            return super().url(name, force=force)
@@ -0,0 +1,106 @@
+import timeit
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from restservice.models import FoodCache, Goals, Users
+from restservice.serializers import *
+from utility import jsonencode
+
+"""
+Micro-benchmarks of building REST response bodies the old way (a DRF Serializer and a new JSONRenderer per
+response) against the new way (compiled field extractors and the shared encoder), for each endpoint.
+Uses unsaved model instances, so it doesn't touch the database, and checks both ways produce the same bytes.
+
+Usage:
+    python manage.py benchmark_json
+    python manage.py benchmark_json --number 200000
+"""
+
+
+def old_points(user, user_goals, food, today):
+    return JSONRenderer().render({"points": UserSerializer(user).data["points"]})
+
+
+def new_points(user, user_goals, food, today):
+    return jsonencode.encode_json(user_points_fields(user))
+
+
+def old_goals(user, user_goals, food, today):
+    return JSONRenderer().render(GoalsSerializer(user_goals).data)
+
+
+def new_goals(user, user_goals, food, today):
+    return jsonencode.encode_json(goals_fields(user_goals))
+
+
+def old_food_info(user, user_goals, food, today):
+    return JSONRenderer().render(FoodCacheSerializer(food).data)
+
+
+def new_food_info(user, user_goals, food, today):
+    return jsonencode.encode_json(food_cache_fields(food))
+
+
+def old_today(user, user_goals, food, today):
+    return JSONRenderer().render(today)
+
+
+def new_today(user, user_goals, food, today):
+    return jsonencode.encode_json(today)
+
+
+ENDPOINTS = [
+    ("points", old_points, new_points),
+    ("goals", old_goals, new_goals),
+    ("food_info", old_food_info, new_food_info),
+    ("today", old_today, new_today),
+]
+
+
+class Command(BaseCommand):
+    help = "Time building REST response bodies with DRF serializers against the compiled extractors"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=50000, help="Responses built per measurement")
+        parser.add_argument("--repeat", type=int, default=5, help="Measurements taken (the fastest is reported)")
+
+    def handle(self, *args, **options):
+        user = Users(user_id="benchmark-client", name="BenchmarkingBouncyBanana", serving_size=100,
+                     sprint=4, points=347, last_checkin=datetime.now())
+        user_goals = Goals(goal_id="0" * 32, user_id=user, water_ml=3500, protein_grams=50, fat_grams=70,
+                           carb_grams=310, kilocalories=2070)
+        food = FoodCache(food_id="0" * 32, food_name="Banana, raw", kilocalories=89, fat_grams=0, carb_grams=23,
+                         protein_grams=1)
+        today = dict(kilocalories=1129, carb_grams=107, fat_grams=53, protein_grams=56, water_ml=250)
+        objects = (user, user_goals, food, today)
+
+        original_encode = jsonencode._encode
+        backends = [("json", jsonencode._encode_stdlib)]
+        if jsonencode.orjson is not None:
+            backends.append(("orjson", jsonencode._encode_orjson))
+
+        self.stdout.write("{:<10} {:>10} {:>10} {:>10} {:>8}".format("endpoint", "backend", "old us", "new us", "speedup"))
+
+        for backend, encode in backends:
+            jsonencode._encode = encode
+
+            for endpoint, old, new in ENDPOINTS:
+                if old(*objects) != new(*objects):
+                    self.stderr.write("{} responses differ with {}: {} != {}".format(
+                        endpoint, backend, old(*objects), new(*objects)))
+
+                old_time = self.measure(old, objects, options)
+                new_time = self.measure(new, objects, options)
+                self.stdout.write("{:<10} {:>10} {:>10.2f} {:>10.2f} {:>7.1f}x".format(
+                    endpoint, backend, old_time, new_time, old_time / new_time))
+
+        jsonencode._encode = original_encode
+
+    def measure(self, fn, objects, options):
+        """
+        :return: The fastest time to build one response, in microseconds
+        """
+        timer = timeit.Timer(lambda: fn(*objects))
+        return min(timer.repeat(repeat=options["repeat"], number=options["number"])) / options["number"] * 1e6
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from utility.dataset import guess_format, open_dataset, parse_record, read_dataset
+from utility.nutritable import write_nutrition_table
+from utility.utils import food_key
+
+"""
+Builds the read-only nutrition table that get_food consults before Nutritics (see utility.nutritable).
+Point the NUTRITION_TABLE_PATH setting at the output file to use it.
+
+Usage:
+    python manage.py build_nutrition_table foods.csv nutrition.bin
+
+See utility.dataset for the columns / keys every record needs.
+"""
+
+
+class Command(BaseCommand):
+    help = "Build a memory-mapped nutrition table file from a CSV or NDJSON dataset (per 100g values)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The dataset to build the table from")
+        parser.add_argument("output", help="Where to write the table")
+        parser.add_argument("--format", choices=["csv", "ndjson"],
+                            help="The dataset's format. Guessed from the file extension if not given")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        data_format = options["format"] or guess_format(path)
+        start = time.monotonic()
+        self.invalid = 0
+
+        with open_dataset(path) as f:
+            count = write_nutrition_table(options["output"], self.foods(read_dataset(f, data_format)))
+
+        self.stdout.write(self.style.SUCCESS("Wrote {} foods to {} ({} invalid records skipped) in {:.1f}s".format(
+            count, options["output"], self.invalid, time.monotonic() - start)))
+
+    def foods(self, records):
+        for line_num, record in records:
+            try:
+                food = parse_record(record)
+            except (KeyError, TypeError, ValueError) as e:
+                self.invalid += 1
+                self.stderr.write("Skipping record {}: {} {}".format(line_num, e.__class__.__name__, e))
+                continue
+
+            food["food_id"] = food_key(food["food_name"])
+            yield food
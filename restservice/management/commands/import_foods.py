@@ -0,0 +1,102 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+
+from restservice.models import FoodCache
+from utility.dataset import guess_format, open_dataset, parse_record, read_dataset
+from utility.utils import food_key
+
+"""
+Pre-seeds the FoodCache from a nutrition dataset, so a fresh database doesn't have to fill up one
+Nutritics call at a time.
+
+Usage:
+    python manage.py import_foods foods.csv
+    python manage.py import_foods foods.ndjson --batch-size 5000
+
+See utility.dataset for the columns / keys every record needs.
+"""
+
+
+class Command(BaseCommand):
+    help = "Stream a CSV or NDJSON nutrition dataset (per 100g values) into the FoodCache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The dataset to import")
+        parser.add_argument("--format", choices=["csv", "ndjson"],
+                            help="The dataset's format. Guessed from the file extension if not given")
+        parser.add_argument("--batch-size", type=int, default=2000,
+                            help="The number of rows written per bulk_create")
+        parser.add_argument("--update", action="store_true",
+                            help="Overwrite foods that are already in the FoodCache instead of skipping them")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        data_format = options["format"] or guess_format(path)
+        batch_size = options["batch_size"]
+
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.start = time.monotonic()
+
+        with open_dataset(path) as f:
+            batch = dict()
+            for line_num, record in read_dataset(f, data_format):
+                try:
+                    food = parse_record(record)
+                    food = FoodCache(food_id=food_key(food["food_name"]), fetched_at=datetime.now(), **food)
+                except (KeyError, TypeError, ValueError) as e:
+                    self.invalid += 1
+                    self.stderr.write("Skipping record {}: {} {}".format(line_num, e.__class__.__name__, e))
+                    continue
+
+                # The last record for a food wins if the dataset has duplicates
+                batch[food.food_id] = food
+                if len(batch) >= batch_size:
+                    self.write_batch(batch, options["update"])
+                    batch = dict()
+
+            if batch:
+                self.write_batch(batch, options["update"])
+
+        self.stdout.write(self.style.SUCCESS(
+            "Done: {} created, {} updated, {} already cached, {} invalid in {:.1f}s".format(
+                self.created, self.updated, self.skipped, self.invalid, time.monotonic() - self.start)))
+
+    def write_batch(self, batch, update):
+        """
+        Write one chunk of foods. Foods that are already cached are skipped (or updated, with --update),
+        and the rest are inserted with a single bulk_create.
+        """
+        existing = set(FoodCache.objects.filter(food_id__in=list(batch)).values_list("food_id", flat=True))
+        new_rows = [food for food_id, food in batch.items() if food_id not in existing]
+
+        try:
+            with transaction.atomic():
+                FoodCache.objects.bulk_create(new_rows)
+            self.created += len(new_rows)
+        except IntegrityError:
+            # Something else inserted some of these foods since we checked, so go one row at a time
+            for food in new_rows:
+                try:
+                    with transaction.atomic():
+                        food.save(force_insert=True)
+                    self.created += 1
+                except IntegrityError:
+                    existing.add(food.food_id)
+
+        if update:
+            with transaction.atomic():
+                for food_id in existing:
+                    batch[food_id].save(force_update=True)
+            self.updated += len(existing)
+        else:
+            self.skipped += len(existing)
+
+        done = self.created + self.updated + self.skipped
+        elapsed = time.monotonic() - self.start
+        self.stdout.write("{} foods processed ({:.0f}/s)".format(done, done / elapsed if elapsed else 0))
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.core.management.base import BaseCommand
+
+"""
+Fires concurrent requests at a running server and reports its throughput and latency, to compare deployments
+(e.g. different worker classes or WEB_THREADS) against each other.
+
+By default every request logs a food the server hasn't seen, so every request waits on a Nutritics lookup. Run it
+against a server whose NUTRITICS_BASE_URL points at nutritics_stub, so the lookups take a known time and the real
+API isn't flooded.
+
+Usage:
+    python manage.py nutritics_stub --delay 0.5 &
+    NUTRITICS_BASE_URL="http://127.0.0.1:8100/search?food=" gunicorn --worker-class gthread --threads 64 dashserver.wsgi &
+    python manage.py loadtest http://127.0.0.1:8000 --requests 2000 --concurrency 200
+"""
+
+
+class Command(BaseCommand):
+    help = "Measure a running server's throughput and latency under concurrent log_food or food_info requests"
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="The server's base URL, e.g. http://127.0.0.1:8000")
+        parser.add_argument("--requests", type=int, default=1000, help="The total number of requests")
+        parser.add_argument("--concurrency", type=int, default=100, help="The number of requests in flight")
+        parser.add_argument("--endpoint", choices=["log_food", "food_info"], default="log_food",
+                            help="The endpoint to call")
+        parser.add_argument("--foods", type=int,
+                            help="The number of different food names to cycle through. Defaults to one per "
+                                 "request, so that none of them are cached")
+        parser.add_argument("--clients", type=int, default=50, help="The number of different client IDs")
+        parser.add_argument("--timeout", type=float, default=60, help="Seconds before a request is given up on")
+
+    def handle(self, *args, **options):
+        base_url = options["url"].rstrip("/")
+        total = options["requests"]
+        concurrency = options["concurrency"]
+        foods = options["foods"] or total
+
+        # A new name for every run, so foods from earlier runs aren't cached
+        run_id = uuid.uuid4().hex[:8]
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        def call(n):
+            client_id = "loadtest-{}-{}".format(run_id, n % options["clients"])
+            food_name = "loadtest {} food {}".format(run_id, n % foods)
+
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+            start = time.monotonic()
+            try:
+                if options["endpoint"] == "log_food":
+                    response = session.post("{}/rest/log_food/{}/".format(base_url, client_id),
+                                            data=json.dumps({"food_name": food_name}),
+                                            headers={"Content-Type": "application/json"},
+                                            timeout=options["timeout"])
+                else:
+                    response = session.get("{}/rest/foodinfo/{}/{}/".format(base_url, client_id, food_name),
+                                           timeout=options["timeout"])
+                status = response.status_code
+            except requests.RequestException as e:
+                status = e.__class__.__name__
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+
+            return status, time.monotonic() - start
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(call, range(total)))
+        elapsed = time.monotonic() - start
+
+        latencies = sorted(latency for status, latency in results if status == 200)
+        failures = dict()
+        for status, _ in results:
+            if status != 200:
+                failures[status] = failures.get(status, 0) + 1
+
+        self.stdout.write("{} {} requests, {} at a time, in {:.2f}s".format(
+            total, options["endpoint"], concurrency, elapsed))
+        self.stdout.write("Throughput:    {:.1f} requests/s".format(len(latencies) / elapsed))
+        self.stdout.write("Max in flight: {}".format(self.max_in_flight))
+        if latencies:
+            self.stdout.write("Latency:       p50 {:.3f}s  p95 {:.3f}s  p99 {:.3f}s  max {:.3f}s".format(
+                self.percentile(latencies, 50), self.percentile(latencies, 95), self.percentile(latencies, 99),
+                latencies[-1]))
+        if failures:
+            self.stderr.write("Failures: {}".format(
+                ", ".join("{} x {}".format(count, status) for status, count in sorted(failures.items(), key=str))))
+
+    def percentile(self, latencies, percent):
+        """
+        :param latencies: Sorted latencies
+        :return: The latency percent% of requests were at least as fast as
+        """
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
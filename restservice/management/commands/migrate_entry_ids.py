@@ -0,0 +1,65 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from restservice.models import Entry
+from utility.ids import ID_LENGTH, MAX_SEQUENCE, OFFLINE_WORKER_ID, compose_id
+
+"""
+Rewrites the IDs of entries made before time-ordered Entry IDs were introduced (32 character md5 hashes) into
+time-ordered IDs based on each entry's time_of_creation. The new IDs use the worker ID reserved for offline
+use, so they can't collide with IDs made by running workers. Safe to re-run: entries that already have a
+time-ordered ID are left alone.
+
+Usage:
+    python manage.py migrate_entry_ids
+"""
+
+
+class Command(BaseCommand):
+    help = "Convert legacy md5 Entry IDs into time-ordered IDs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="The number of entries converted per transaction")
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        batch_size = options["batch_size"]
+        converted = 0
+
+        last_ms = None
+        sequence = 0
+
+        while True:
+            legacy = list(
+                Entry.objects.exclude(entry_id__regex=r"^[0-9A-Z]{{{}}}$".format(ID_LENGTH))
+                .order_by("time_of_creation", "entry_id")
+                .values_list("entry_id", "time_of_creation")[:batch_size]
+            )
+            if not legacy:
+                break
+
+            with transaction.atomic():
+                for old_id, time_of_creation in legacy:
+                    timestamp_ms = int(time_of_creation.timestamp() * 1000)
+                    if last_ms is not None and timestamp_ms <= last_ms:
+                        timestamp_ms = last_ms
+                        sequence += 1
+                        if sequence > MAX_SEQUENCE:
+                            # More than 4096 entries in one millisecond: borrow the next one
+                            timestamp_ms += 1
+                            sequence = 0
+                    else:
+                        sequence = 0
+                    last_ms = timestamp_ms
+
+                    new_id = compose_id(timestamp_ms, OFFLINE_WORKER_ID, sequence)
+                    Entry.objects.filter(entry_id=old_id).update(entry_id=new_id)
+
+            converted += len(legacy)
+            self.stdout.write("{} entries converted".format(converted))
+
+        self.stdout.write(self.style.SUCCESS("Converted {} entries in {:.1f}s".format(
+            converted, time.monotonic() - start)))
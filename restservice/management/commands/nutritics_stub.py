@@ -0,0 +1,71 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management.base import BaseCommand
+
+"""
+A stand-in for Nutritics that knows every food, and answers after a fixed delay, for load testing without
+hitting the real API. Point a server at it with NUTRITICS_BASE_URL (see loadtest).
+
+Usage:
+    python manage.py nutritics_stub
+    python manage.py nutritics_stub --port 8100 --delay 0.5
+"""
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.5
+
+    def do_GET(self):
+        food_name = parse_qs(urlparse(self.path).query).get("food", [""])[0]
+        time.sleep(self.delay)
+
+        # The food is named after the query, so every name is a different food to the server
+        body = json.dumps({
+            "status": 200,
+            "1": {
+                "name": food_name,
+                "energyKcal": {"val": 250},
+                "protein": {"val": 10},
+                "fat": {"val": 10},
+                "carbohydrate": {"val": 30},
+            },
+        }).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Serve a fake Nutritics API that answers every search after a delay"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8100, help="The port to listen on")
+        parser.add_argument("--delay", type=float, default=0.5, help="Seconds to wait before each answer")
+
+    def handle(self, *args, **options):
+        StubHandler.delay = options["delay"]
+        server = StubServer(("127.0.0.1", options["port"]), StubHandler)
+
+        self.stdout.write("Set NUTRITICS_BASE_URL=http://127.0.0.1:{}/search?food= (answering after {}s)".format(
+            options["port"], options["delay"]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
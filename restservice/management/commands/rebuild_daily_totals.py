@@ -0,0 +1,91 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, TruncDate
+
+from restservice.models import DailyTotals, Entry
+from utility.utils import md5_hash_string
+
+"""
+Rebuilds the DailyTotals table from the Entry table, e.g. after entries were edited by hand, or to check that
+the running totals haven't drifted. Entries logged while the rebuild is running may be missed, so run it
+when logging is quiet (or re-run it for the affected days).
+
+Usage:
+    python manage.py rebuild_daily_totals
+    python manage.py rebuild_daily_totals --user <client_id> --since 2018-03-01
+"""
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-user, per-day totals in DailyTotals from Entry"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", help="Only rebuild this user's totals")
+        parser.add_argument("--since", help="Only rebuild days on or after this date (YYYY-MM-DD)")
+        parser.add_argument("--batch-size", type=int, default=2000,
+                            help="The number of rows written per bulk_create")
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+
+        entries = Entry.objects.all()
+        totals = DailyTotals.objects.all()
+
+        if options["user"]:
+            entries = entries.filter(user_id=options["user"])
+            totals = totals.filter(user_id=options["user"])
+
+        if options["since"]:
+            try:
+                since = datetime.strptime(options["since"], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--since must be a date in the form YYYY-MM-DD")
+            entries = entries.filter(time_of_creation__gte=since)
+            totals = totals.filter(day__gte=since.date())
+
+        days = entries\
+            .annotate(day=TruncDate("time_of_creation"))\
+            .values("user_id", "day")\
+            .annotate(
+                kilocalories=Sum("kilocalories"),
+                fat_grams=Sum("fat_grams"),
+                carb_grams=Sum("carb_grams"),
+                protein_grams=Sum("protein_grams"),
+                water_ml=Coalesce(Sum("water_ml"), 0),
+                entry_count=Count("entry_id")
+            )\
+            .order_by()
+
+        count = 0
+        with transaction.atomic():
+            deleted, _ = totals.delete()
+
+            batch = []
+            for day in days.iterator():
+                batch.append(DailyTotals(
+                    totals_id=md5_hash_string(day["user_id"] + day["day"].isoformat()),
+                    user_id_id=day["user_id"],
+                    day=day["day"],
+                    kilocalories=day["kilocalories"],
+                    fat_grams=day["fat_grams"],
+                    carb_grams=day["carb_grams"],
+                    protein_grams=day["protein_grams"],
+                    water_ml=day["water_ml"],
+                    entry_count=day["entry_count"]
+                ))
+
+                if len(batch) >= options["batch_size"]:
+                    DailyTotals.objects.bulk_create(batch)
+                    count += len(batch)
+                    self.stdout.write("{} days rebuilt".format(count))
+                    batch = []
+
+            DailyTotals.objects.bulk_create(batch)
+            count += len(batch)
+
+        self.stdout.write(self.style.SUCCESS("Replaced {} rows with {} rebuilt days in {:.1f}s".format(
+            deleted, count, time.monotonic() - start)))
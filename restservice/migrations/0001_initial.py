@@ -0,0 +1,77 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FoodCache',
+            fields=[
+                ('food_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('food_name', models.CharField(max_length=100)),
+                ('kilocalories', models.IntegerField()),
+                ('fat_grams', models.IntegerField()),
+                ('carb_grams', models.IntegerField()),
+                ('protein_grams', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Users',
+            fields=[
+                ('user_id', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('serving_size', models.IntegerField(default=100)),
+                ('sprint', models.IntegerField()),
+                ('points', models.IntegerField()),
+                ('last_checkin', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MealCache',
+            fields=[
+                ('meal_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('meal_name', models.CharField(max_length=100)),
+                ('kilocalories', models.IntegerField()),
+                ('fat_grams', models.IntegerField()),
+                ('carb_grams', models.IntegerField()),
+                ('protein_grams', models.IntegerField()),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='restservice.Users')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Goals',
+            fields=[
+                ('goal_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('water_ml', models.IntegerField()),
+                ('protein_grams', models.IntegerField()),
+                ('fat_grams', models.IntegerField()),
+                ('carb_grams', models.IntegerField()),
+                ('kilocalories', models.IntegerField()),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='restservice.Users')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Entry',
+            fields=[
+                ('entry_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('time_of_creation', models.DateTimeField()),
+                ('entry_name', models.CharField(blank=True, max_length=100, null=True)),
+                ('is_meal', models.BooleanField(default=False)),
+                ('kilocalories', models.IntegerField()),
+                ('fat_grams', models.IntegerField()),
+                ('carb_grams', models.IntegerField()),
+                ('protein_grams', models.IntegerField()),
+                ('water_ml', models.IntegerField(null=True)),
+                ('is_water', models.BooleanField(default=False)),
+                ('user_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='restservice.Users')),
+            ],
+        ),
+    ]
@@ -0,0 +1,114 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:31
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, TruncDate
+import django.db.models.deletion
+
+
+def fill_daily_totals(apps, schema_editor):
+    """
+    Sum the entries logged before DailyTotals existed into it, the same way the rebuild_daily_totals command does.
+    Otherwise a day's first new entry would start its totals from zero.
+    """
+    Entry = apps.get_model("restservice", "Entry")
+    DailyTotals = apps.get_model("restservice", "DailyTotals")
+
+    days = Entry.objects\
+        .annotate(day=TruncDate("time_of_creation"))\
+        .values("user_id", "day")\
+        .annotate(
+            kilocalories=Sum("kilocalories"),
+            fat_grams=Sum("fat_grams"),
+            carb_grams=Sum("carb_grams"),
+            protein_grams=Sum("protein_grams"),
+            water_ml=Coalesce(Sum("water_ml"), 0),
+            entry_count=Count("entry_id")
+        )\
+        .order_by()
+
+    DailyTotals.objects.bulk_create([
+        DailyTotals(
+            totals_id=hashlib.md5((day["user_id"] + day["day"].isoformat()).encode("utf-8")).hexdigest(),
+            user_id_id=day["user_id"],
+            day=day["day"],
+            kilocalories=day["kilocalories"],
+            fat_grams=day["fat_grams"],
+            carb_grams=day["carb_grams"],
+            protein_grams=day["protein_grams"],
+            water_ml=day["water_ml"],
+            entry_count=day["entry_count"]
+        )
+        for day in days.iterator()
+    ], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restservice', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTotals',
+            fields=[
+                ('totals_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('day', models.DateField()),
+                ('kilocalories', models.IntegerField(default=0)),
+                ('fat_grams', models.IntegerField(default=0)),
+                ('carb_grams', models.IntegerField(default=0)),
+                ('protein_grams', models.IntegerField(default=0)),
+                ('water_ml', models.IntegerField(default=0)),
+                ('entry_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FoodAlias',
+            fields=[
+                ('alias_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('alias', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IdempotentResponse',
+            fields=[
+                ('request_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('status_code', models.IntegerField()),
+                ('content_type', models.CharField(max_length=100)),
+                ('content', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='foodcache',
+            name='fetched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='users',
+            name='data_version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['user_id', 'time_of_creation'], name='entry_user_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='foodalias',
+            name='food_id',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='restservice.FoodCache'),
+        ),
+        migrations.AddField(
+            model_name='dailytotals',
+            name='user_id',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='restservice.Users'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailytotals',
+            unique_together={('user_id', 'day')},
+        ),
+        migrations.RunPython(fill_daily_totals, migrations.RunPython.noop),
+    ]
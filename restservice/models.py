@@ -8,6 +8,8 @@ class Users(models.Model):
     sprint = models.IntegerField()
     points = models.IntegerField()
     last_checkin = models.DateTimeField()   # Used to calculate the streak, updated with every logging request
+    # Bumped whenever the user's entries, points or goals change. Used to validate cached insights pages
+    data_version = models.IntegerField(default=0)
 
     def __str__(self):
         return self.user_id
@@ -31,7 +33,8 @@ class Entry(models.Model):
     Each entry is one thing that user user_id ate, with the nutrition data
     scaled to the appropriate amounts, given the user's portion size.
     """
-    # EntryID is generated by md5 hashing the concatenation of user_id and time_of_creation
+    # EntryID is a time-ordered ID generated by utils.new_entry_id(). Entries made before those IDs were introduced
+    # used the md5 hash of the concatenation of user_id and time_of_creation (see the migrate_entry_ids command)
     entry_id = models.CharField(max_length=32, primary_key=True)
     user_id = models.ForeignKey("Users", on_delete=models.CASCADE)
     time_of_creation = models.DateTimeField()
@@ -44,10 +47,40 @@ class Entry(models.Model):
     water_ml = models.IntegerField(null=True)
     is_water = models.BooleanField(default=False)
 
+    class Meta:
+        # Every per-day query filters on the user and a time range
+        indexes = [
+            models.Index(fields=["user_id", "time_of_creation"], name="entry_user_time_idx"),
+        ]
+
     def __str__(self):
         return self.entry_id
 
 
+class DailyTotals(models.Model):
+    """
+    Running totals of everything user user_id has logged on one day. Updated in the same transaction as
+    every Entry insert, so reading "today" is a single row lookup instead of a scan of the day's entries.
+    Can be rebuilt from Entry with the rebuild_daily_totals command.
+    """
+    # ID is generated from the MD5 hash of the user_id concatenated with the day (YYYY-MM-DD)
+    totals_id = models.CharField(primary_key=True, max_length=32)
+    user_id = models.ForeignKey("Users", on_delete=models.CASCADE)
+    day = models.DateField()
+    kilocalories = models.IntegerField(default=0)
+    fat_grams = models.IntegerField(default=0)
+    carb_grams = models.IntegerField(default=0)
+    protein_grams = models.IntegerField(default=0)
+    water_ml = models.IntegerField(default=0)
+    entry_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user_id", "day")
+
+    def __str__(self):
+        return self.totals_id
+
+
 class MealCache(models.Model):
     """
     Nutrition data for meals that the user creates.
@@ -68,7 +101,8 @@ class MealCache(models.Model):
 
 class FoodCache(models.Model):
 
-    # Hash is generated by calling the md5_hash_string() function on the food's name
+    # Hash is generated by calling the food_key() function (md5_hash_string() of the normalized name)
+    # on the food's canonical name, as returned by Nutritics
     food_id = models.CharField(primary_key=True, max_length=32)
     food_name = models.CharField(max_length=100)
     # All these measurements are ALWAYS per 100 grams of food
@@ -76,6 +110,39 @@ class FoodCache(models.Model):
     fat_grams = models.IntegerField()
     carb_grams = models.IntegerField()
     protein_grams = models.IntegerField()
+    # When the nutrition data was fetched. Rows older than FOOD_STALE_AFTER_DAYS (or without a time) are
+    # still served, but refreshed from Nutritics in the background
+    fetched_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.food_id
+
+
+class FoodAlias(models.Model):
+    """
+    Maps another way of saying a food's name onto the FoodCache record for that food,
+    e.g. "banana" -> "Banana, raw".
+    """
+    # Hash is generated by calling the food_key() function on the alias
+    alias_id = models.CharField(primary_key=True, max_length=32)
+    alias = models.CharField(max_length=100)
+    food_id = models.ForeignKey("FoodCache", on_delete=models.CASCADE)
+
+    def __str__(self):
+        return self.alias_id
+
+
+class IdempotentResponse(models.Model):
+    """
+    The response a logging request with an idempotency key got, replayed to retries of that request.
+    Rows older than IDEMPOTENCY_TTL are deleted as new ones are stored.
+    """
+    # ID is generated from the MD5 hash of the request path concatenated with the idempotency key
+    request_id = models.CharField(primary_key=True, max_length=32)
+    status_code = models.IntegerField()
+    content_type = models.CharField(max_length=100)
+    content = models.TextField(blank=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.request_id
@@ -0,0 +1,50 @@
+from utility import utilconstants
+from utility.schema import Field, compile_schema
+
+"""
+Schemas of the JSON bodies the REST endpoints accept, compiled into validators at import.
+Validate a request with utility.schema.parse_body(request, <validator>) before doing any other work.
+"""
+
+FOOD_NAME = Field("string", max_length=100)
+SERVING = Field("number", required=False, minimum=1, maximum=10000)   # grams
+WATER_ML = Field("number", minimum=1, maximum=10000)
+
+log_food_body = compile_schema({
+    "food_name": FOOD_NAME,
+    "serving": SERVING,
+})
+
+log_meal_body = compile_schema({
+    "meal_name": Field("string", max_length=100),
+})
+
+log_water_body = compile_schema({
+    "water_ml": WATER_ML,
+})
+
+create_meal_body = compile_schema({
+    "meal_name": Field("string", max_length=100),
+    "food_details": Field("object_map", values=50, schema={
+        "name": FOOD_NAME,
+        "serving": SERVING,
+    }),
+})
+
+# Goals are divided by when scoring, so they must be positive
+goals_body = compile_schema(
+    {goal_param: Field("number", minimum=1, maximum=100000) for goal_param in utilconstants.GOAL_PARAM_NAMES},
+    require_any=True
+)
+
+# Items are checked one at a time against batch_item_bodies, so one bad item doesn't reject the whole batch
+log_batch_body = compile_schema({
+    "items": Field("list", values=50),
+})
+
+# The items of a log_batch body, by type
+batch_item_bodies = {
+    "food": log_food_body,
+    "meal": log_meal_body,
+    "water": log_water_body,
+}
@@ -3,6 +3,35 @@ from rest_framework import serializers
 from restservice.models import *
 from utility import utilconstants
 from utility import utils
+from utility.jsonencode import compile_extractor
+
+"""
+Response bodies are built with the extractors below, which emit the same JSON as the matching Serializer's .data
+(FoodCacheSerializer leaves out food_hash, which FoodCache doesn't have).
+"""
+
+food_cache_fields = compile_extractor(
+    ("food_name", "food_name", str),
+    ("kilocalories", "kilocalories", int),
+    ("fat_grams", "fat_grams", int),
+    ("carb_grams", "carb_grams", int),
+    ("protein_grams", "protein_grams", int),
+)
+
+user_points_fields = compile_extractor(
+    ("points", "points", int),
+)
+
+# Goals.user_id is a Users, whose str() is its primary key, so the FK's raw value gives the same output
+goals_fields = compile_extractor(
+    ("goal_id", "goal_id", str),
+    ("user_id", "user_id_id", str),
+    ("water_ml", "water_ml", int),
+    ("protein_grams", "protein_grams", int),
+    ("fat_grams", "fat_grams", int),
+    ("carb_grams", "carb_grams", int),
+    ("kilocalories", "kilocalories", int),
+)
 
 
 class FoodCacheSerializer(serializers.Serializer):
@@ -1 +1,724 @@
-# Create your tests here.
+import json
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler
+from unittest import mock
+
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from restservice.management.commands.nutritics_stub import StubServer
+from restservice.models import Entry, FoodCache, Goals, IdempotentResponse, Users
+from restservice.schemas import create_meal_body, goals_body, log_food_body
+from utility import utils
+from utility.idempotency import IN_PROGRESS, idempotent, request_key, response_cache
+from utility.ids import ID_LENGTH, OFFLINE_WORKER_ID, IdGenerator, compose_id, default_worker_base
+from utility.lrucache import LRUCache
+from utility.normalize import normalize_food_name, singularize
+from utility.nutritics import CircuitBreaker, CircuitOpenError, NutriticsClient, NutriticsError
+from utility.schema import SchemaError
+from utility.singleflight import SingleFlight, file_lease
+
+
+class PointsTestCase(TestCase):
+    """
+    Points awarded for each entry are the change it makes to the day's score, so whatever order a day's entries
+    are logged in, the points awarded over the day add up to the score of the day's final totals.
+    """
+    day_start = datetime(2018, 4, 2)
+
+    goals = [
+        dict(water_ml=3500, protein_grams=50, fat_grams=70, carb_grams=310, kilocalories=2070),
+        dict(water_ml=2000, protein_grams=120, fat_grams=40, carb_grams=150, kilocalories=1500),
+        dict(water_ml=1, protein_grams=1, fat_grams=1, carb_grams=1, kilocalories=1),
+    ]
+
+    sprints = [1, 3, 12]
+
+    def test_points_sum_to_day_score(self):
+        rng = random.Random(2018)
+
+        for goal_num, goal_values in enumerate(self.goals):
+            for sprint in self.sprints:
+                for run in range(5):
+                    client_id = "points-{}-{}-{}".format(goal_num, sprint, run)
+                    with self.subTest(goals=goal_values, sprint=sprint, run=run):
+                        self.check_random_day(rng, client_id, goal_values, sprint)
+
+    def check_random_day(self, rng, client_id, goal_values, sprint):
+        # Checked in earlier the same day, so the sprint doesn't change while logging
+        user = Users.objects.create(user_id=client_id, name=client_id, sprint=sprint, points=0,
+                                    last_checkin=self.day_start)
+        user_goals = Goals.objects.create(goal_id=utils.md5_hash_string(client_id), user_id=user, **goal_values)
+
+        awarded = 0
+        log_time = self.day_start + timedelta(hours=7)
+        for _ in range(rng.randint(1, 12)):
+            log_time += timedelta(minutes=rng.randint(1, 60))
+            # A single food or water, or a meal's foods, logged together
+            entries = [self.random_entry(rng, user, log_time) for _ in range(rng.choice([1, 1, 1, 2, 4]))]
+
+            utils.log_entries(user, user_goals, entries)
+
+            points = Users.objects.get(user_id=client_id).points
+            delta, awarded = points - awarded, points
+            self.assertEqual(delta % sprint, 0)
+
+        final_totals = utils.get_today_macros(user, log_time)
+        self.assertEqual(awarded, sprint * utils.day_score(final_totals, user_goals))
+
+    def random_entry(self, rng, user, log_time):
+        is_water = rng.random() < 0.25
+        return Entry(
+            entry_id=utils.new_entry_id(),
+            user_id=user,
+            time_of_creation=log_time,
+            entry_name="water" if is_water else "food",
+            kilocalories=0 if is_water else rng.randint(0, 900),
+            fat_grams=0 if is_water else rng.randint(0, 60),
+            carb_grams=0 if is_water else rng.randint(0, 120),
+            protein_grams=0 if is_water else rng.randint(0, 60),
+            water_ml=rng.randint(50, 1000) if is_water else None,
+            is_water=is_water
+        )
+
+
+class ScriptedStubHandler(BaseHTTPRequestHandler):
+    """
+    A Nutritics stand-in that answers each request with the next (HTTP status, delay in seconds, found) from script,
+    and with (200, 0, True) once the script runs out. Found foods are named after the query. Foods with "unknown" in
+    their name are never found, whatever the script says, since concurrent lookups reach the stub in any order.
+    """
+    script = []
+    requests = 0
+
+    def do_GET(self):
+        ScriptedStubHandler.requests += 1
+        http_status, delay, found = self.script.pop(0) if self.script else (200, 0, True)
+        time.sleep(delay)
+
+        food_name = self.path.split("food=", 1)[1].split("&", 1)[0]
+        if found and "unknown" not in food_name:
+            body = {"status": 200, "1": {"name": food_name, "energyKcal": {"val": 250}, "protein": {"val": 10},
+                                         "fat": {"val": 10}, "carbohydrate": {"val": 30}}}
+        else:
+            body = {"status": 404}
+        content = json.dumps(body).encode("utf-8")
+
+        try:
+            self.send_response(http_status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        except OSError:
+            # The client gave up waiting
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubTestMixin:
+    """
+    Runs a ScriptedStubHandler on a free local port for each test, at self.base_url.
+    """
+    def setUp(self):
+        super().setUp()
+        ScriptedStubHandler.script = []
+        ScriptedStubHandler.requests = 0
+
+        server = StubServer(("127.0.0.1", 0), ScriptedStubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.base_url = "http://127.0.0.1:{}/search?food=".format(server.server_address[1])
+
+    def nutritics_client(self, **kwargs):
+        kwargs.setdefault("backoff", 0)
+        return NutriticsClient(base_url=self.base_url, auth=None, **kwargs)
+
+    def look_foods_up_on_stub(self, **kwargs):
+        """
+        Make the app's food lookups go to the stub, with a client made from kwargs, for the rest of the test.
+        """
+        original_client = utils.nutritics_client
+        utils.nutritics_client = self.nutritics_client(**kwargs)
+        self.addCleanup(setattr, utils, "nutritics_client", original_client)
+
+
+class NutriticsClientTestCase(StubTestMixin, SimpleTestCase):
+    """
+    Retries, timeouts and the circuit breaker of NutriticsClient, against a local stub server.
+    """
+    def test_retries_server_errors(self):
+        ScriptedStubHandler.script = [(500, 0, True), (502, 0, True)]
+        client = self.nutritics_client(max_retries=2)
+
+        self.assertEqual(client.search_food("banana")["1"]["name"], "banana")
+        self.assertEqual(ScriptedStubHandler.requests, 3)
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_gives_up_after_retries(self):
+        ScriptedStubHandler.script = [(500, 0, True)] * 3
+        client = self.nutritics_client(max_retries=2)
+
+        with self.assertRaises(NutriticsError):
+            client.search_food("banana")
+        self.assertEqual(ScriptedStubHandler.requests, 3)
+        self.assertEqual(client.breaker.failures, 1)
+
+    def test_read_timeout(self):
+        ScriptedStubHandler.script = [(200, 1, True)]
+        client = self.nutritics_client(read_timeout=0.1, max_retries=0)
+
+        start = time.monotonic()
+        with self.assertRaises(NutriticsError):
+            client.search_food("banana")
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_open_breaker_fails_fast(self):
+        ScriptedStubHandler.script = [(500, 0, True)] * 2
+        client = self.nutritics_client(max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+
+        for _ in range(2):
+            with self.assertRaises(NutriticsError):
+                client.search_food("banana")
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            client.search_food("banana")
+        self.assertEqual(ScriptedStubHandler.requests, 2)
+
+    def test_half_open_trial(self):
+        ScriptedStubHandler.script = [(500, 0, True), (500, 0, True)]
+        client = self.nutritics_client(max_retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.1))
+
+        with self.assertRaises(NutriticsError):
+            client.search_food("banana")
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+
+        # A failed trial opens the breaker again, a successful one closes it
+        time.sleep(0.15)
+        with self.assertRaises(NutriticsError):
+            client.search_food("banana")
+        self.assertEqual(client.breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.15)
+        client.search_food("banana")
+        self.assertEqual(client.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(ScriptedStubHandler.requests, 3)
+
+
+class FoodLookupErrorTestCase(StubTestMixin, TestCase):
+    """
+    Foods Nutritics has no match for are a 404, and a failing Nutritics (or an open breaker) is a 503.
+    """
+    def setUp(self):
+        super().setUp()
+        self.look_foods_up_on_stub(max_retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+
+    def log_food(self, food_name):
+        return self.post("/rest/log_food/lookup-errors/", {"food_name": food_name})
+
+    def post(self, path, body):
+        return self.client.post(path, json.dumps(body), content_type="application/json")
+
+    def test_food_not_found(self):
+        ScriptedStubHandler.script = [(200, 0, False)]
+
+        response = self.log_food("no such food")
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("error", json.loads(response.content.decode("utf-8")))
+
+    def test_nutritics_failing(self):
+        ScriptedStubHandler.script = [(500, 0, True)]
+
+        self.assertEqual(self.log_food("failing food").status_code, 503)
+        # The breaker is open now, so the next lookup doesn't reach Nutritics
+        self.assertEqual(self.log_food("another food").status_code, 503)
+        self.assertEqual(ScriptedStubHandler.requests, 1)
+
+    def test_batch_lookup_errors(self):
+        ScriptedStubHandler.script = [(200, 0, False)]
+
+        response = self.post("/rest/log_batch/lookup-errors/", {"items": [
+            {"type": "food", "food_name": "unknown food"},
+            {"type": "water", "water_ml": 250},
+        ]})
+        results = json.loads(response.content.decode("utf-8"))["results"]
+        self.assertEqual([result["status"] for result in results], [404, 200])
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2, ttl=None)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Reading "a" makes "b" the least recently used
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        cache = LRUCache(max_size=10, ttl=0.05)
+        cache.set("short", 1)
+        cache.set("long", 2, ttl=60)
+        time.sleep(0.1)
+
+        self.assertEqual(cache.get("short", "missing"), "missing")
+        self.assertEqual(cache.get("long"), 2)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_invalidate_and_stats(self):
+        cache = LRUCache(max_size=10)
+        cache.set("a", 1)
+        cache.invalidate("a")
+
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        cache.get("a")
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (1, 1, 0.5))
+
+    def test_zero_size_stores_nothing(self):
+        cache = LRUCache(max_size=0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def run_concurrently(self, flight, key, fn, count=5):
+        """
+        Start count threads calling flight.do(key, fn) while fn is blocked, then let it finish.
+        :return: A list of what each thread got back: ("result", value) or ("error", exception)
+        """
+        outcomes = []
+        outcomes_lock = threading.Lock()
+
+        def call():
+            try:
+                outcome = ("result", flight.do(key, fn))
+            except Exception as e:
+                outcome = ("error", e)
+            with outcomes_lock:
+                outcomes.append(outcome)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        # Every thread is either the leader inside fn, or waiting on it
+        while flight.in_flight() == 0:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        return outcomes
+
+    def slow_lookup(self):
+        self.calls += 1
+        self.release.wait()
+        return "banana"
+
+    def failing_lookup(self):
+        self.calls += 1
+        self.release.wait()
+        raise ValueError("lookup failed")
+
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+
+        outcomes = self.run_concurrently(flight, "banana", self.slow_lookup)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [("result", "banana")] * 5)
+        self.assertEqual(flight.in_flight(), 0)
+
+    def test_error_reaches_every_caller(self):
+        flight = SingleFlight()
+
+        outcomes = self.run_concurrently(flight, "banana", self.failing_lookup)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([kind for kind, _ in outcomes], ["error"] * 5)
+        self.assertTrue(all(isinstance(error, ValueError) for _, error in outcomes))
+
+        # The failed call isn't remembered, so the next one runs again
+        self.assertEqual(flight.do("banana", lambda: "retried"), "retried")
+
+    def test_file_lease_is_exclusive(self):
+        directory = tempfile.mkdtemp()
+
+        with file_lease(directory, "banana") as acquired:
+            self.assertTrue(acquired)
+            with file_lease(directory, "banana", timeout=0.1) as acquired_again:
+                self.assertFalse(acquired_again)
+            with file_lease(directory, "apple", timeout=0.1) as other_acquired:
+                self.assertTrue(other_acquired)
+
+        with file_lease(directory, "banana", timeout=0.1) as acquired:
+            self.assertTrue(acquired)
+
+
+class NormalizeTestCase(SimpleTestCase):
+    def test_singularize(self):
+        cases = {
+            "bananas": "banana", "berries": "berry", "tomatoes": "tomato", "peaches": "peach",
+            "cookies": "cookie", "pies": "pie", "brownies": "brownie", "smoothies": "smoothie", "quiches": "quiche",
+            "hummus": "hummus", "asparagus": "asparagus", "oats": "oats", "glass": "glass", "egg": "egg",
+        }
+        for plural, singular in cases.items():
+            with self.subTest(word=plural):
+                self.assertEqual(singularize(plural), singular)
+
+    def test_normalize_food_name(self):
+        cases = {
+            "Banana": "banana",
+            "  a Banana , ripe ": "banana ripe",
+            "The Bananas": "banana",
+            "2% milk": "2 milk",
+            "the": "the",
+            "!!!": "!!!",
+        }
+        for name, normalized in cases.items():
+            with self.subTest(name=name):
+                self.assertEqual(normalize_food_name(name), normalized)
+
+    def test_food_key_shares_phrasings(self):
+        self.assertEqual(utils.food_key("Cookies"), utils.food_key("a cookie"))
+        self.assertEqual(utils.food_key("Bananas"), utils.md5_hash_string("banana"))
+        self.assertNotEqual(utils.food_key("banana"), utils.food_key("bacon"))
+
+
+class IdGeneratorTestCase(SimpleTestCase):
+    def test_ids_are_ordered_and_unique(self):
+        generator = IdGenerator(worker_id=1)
+        ids = [generator.new_id() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertTrue(all(len(entry_id) == ID_LENGTH for entry_id in ids))
+
+    def test_unique_across_threads(self):
+        generator = IdGenerator(worker_id=1)
+        ids = []
+        ids_lock = threading.Lock()
+
+        def make_ids():
+            made = [generator.new_id() for _ in range(2000)]
+            with ids_lock:
+                ids.extend(made)
+
+        threads = [threading.Thread(target=make_ids) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(ids)), 16000)
+
+    def test_clock_going_backwards(self):
+        generator = IdGenerator(worker_id=1)
+        with mock.patch("utility.ids.time.time", return_value=1600000000.0):
+            first = generator.new_id()
+        with mock.patch("utility.ids.time.time", return_value=1599999999.0):
+            second = generator.new_id()
+
+        self.assertLess(first, second)
+
+    def test_processes_claim_different_worker_ids(self):
+        lock_dir = tempfile.mkdtemp()
+        # Each generator claims its slot with its own lock file, just like a separate process would
+        generators = [IdGenerator(worker_base=8, workers_per_host=2, lock_dir=lock_dir) for _ in range(2)]
+
+        with mock.patch("utility.ids.time.time", return_value=1600000000.0):
+            ids = [generator.new_id() for generator in generators]
+        self.assertEqual(ids, [compose_id(1600000000000, 8, 0), compose_id(1600000000000, 9, 0)])
+
+        # A third process on the same machine has no slot left
+        with self.assertRaises(RuntimeError):
+            IdGenerator(worker_base=8, workers_per_host=2, lock_dir=lock_dir).new_id()
+
+    def test_dyno_worker_bases(self):
+        bases = dict()
+        for dyno in ["web.1", "web.2", "web.56", "web.57", "web.64", "web.1000", "run.1234", "release.5678",
+                     "worker.1", "scheduler.3", ""]:
+            with mock.patch.dict("os.environ", {"DYNO": dyno}):
+                bases[dyno] = default_worker_base(16)
+                # Every base must be usable, however many dynos there are
+                IdGenerator(worker_base=bases[dyno], workers_per_host=16, lock_dir=tempfile.mkdtemp())
+
+        self.assertEqual((bases["web.1"], bases["web.2"], bases["web.56"]), (0, 16, 880))
+        # More web dynos than ranges wrap around
+        self.assertEqual(bases["web.57"], 0)
+        self.assertEqual(bases[""], 0)
+
+        web_bases = set(base for dyno, base in bases.items() if dyno.startswith("web."))
+        other_bases = set(bases[dyno] for dyno in ["run.1234", "release.5678", "worker.1", "scheduler.3"])
+        self.assertFalse(web_bases & other_bases)
+
+    def test_worker_ids_are_checked(self):
+        with self.assertRaises(ValueError):
+            IdGenerator(worker_id=OFFLINE_WORKER_ID + 1)
+        with self.assertRaises(ValueError):
+            IdGenerator(worker_base=OFFLINE_WORKER_ID - 1, workers_per_host=2, lock_dir=tempfile.mkdtemp())
+
+
+class LogBatchTestCase(StubTestMixin, TransactionTestCase):
+    """
+    Every item of a batch gets the result its single item endpoint would have given, in the same order.
+    A TransactionTestCase, since foods that aren't cached are stored by get_foods()'s own threads.
+    """
+    client_id = "log-batch"
+
+    def setUp(self):
+        super().setUp()
+        self.look_foods_up_on_stub(max_retries=0)
+
+    def log_batch(self, items):
+        response = self.client.post("/rest/log_batch/{}/".format(self.client_id), json.dumps({"items": items}),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode("utf-8"))["results"]
+
+    def test_per_item_results(self):
+        self.client.post("/rest/create_meal/{}/".format(self.client_id), json.dumps({
+            "meal_name": "batch breakfast", "food_details": {"food1": {"name": "batch eggs", "serving": 100}}
+        }), content_type="application/json")
+
+        results = self.log_batch([
+            {"type": "food", "food_name": "batch toast", "serving": 50},
+            {"type": "food", "food_name": "batch unknown"},
+            {"type": "meal", "meal_name": "batch breakfast"},
+            {"type": "meal", "meal_name": "batch dinner"},
+            {"type": "water", "water_ml": 250},
+            {"type": "water", "water_ml": -1},
+            {"type": "juice"},
+            {"type": ["food"]},
+            "banana",
+        ])
+
+        self.assertEqual([result["status"] for result in results], [200, 404, 200, 403, 200, 400, 400, 400, 400])
+
+        entries = Entry.objects.filter(user_id=self.client_id)
+        self.assertEqual(sorted(entry.entry_name for entry in entries), ["batch breakfast", "batch toast", "water"])
+        self.assertEqual(sum(entry.water_ml or 0 for entry in entries), 250)
+        # 50g of a food the stub says has 250 kcal per 100g, and the meal's 100g of the same kind of food
+        self.assertEqual(sum(entry.kilocalories for entry in entries), 125 + 250)
+
+    def test_duplicate_foods_are_looked_up_once(self):
+        results = self.log_batch([{"type": "food", "food_name": "batch apple"}] * 3)
+
+        self.assertEqual([result["status"] for result in results], [200] * 3)
+        self.assertEqual(ScriptedStubHandler.requests, 1)
+        self.assertEqual(Entry.objects.filter(user_id=self.client_id).count(), 3)
+
+    def test_shares_lookups_with_get_food(self):
+        ScriptedStubHandler.script = [(200, 0.3, True)]
+        single = []
+        thread = threading.Thread(target=lambda: single.append(utils.get_food("batch shared")))
+        thread.start()
+        while utils.food_flight.in_flight() == 0:
+            time.sleep(0.01)
+
+        foods = utils.get_foods(["batch shared", "batch other"])
+        thread.join()
+
+        # One request for each food, though "batch shared" was looked up twice at once
+        self.assertEqual(ScriptedStubHandler.requests, 2)
+        self.assertEqual(foods["batch shared"].food_id, single[0].food_id)
+        self.assertEqual(FoodCache.objects.count(), 2)
+
+    def test_batch_is_capped(self):
+        for items in [[{"type": "water", "water_ml": 250}] * 51, [], {"type": "water"}]:
+            with self.subTest(items=len(items)):
+                response = self.client.post("/rest/log_batch/{}/".format(self.client_id),
+                                            json.dumps({"items": items}), content_type="application/json")
+                self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(Entry.objects.filter(user_id=self.client_id).count(), 0)
+
+
+class IdempotencyTestCase(TestCase):
+    """
+    A request repeating an idempotency key gets the first response back, without being handled again.
+    """
+    def log_water(self, client_id, body_key=None, **headers):
+        body = {"water_ml": 250}
+        if body_key is not None:
+            body["idempotency_key"] = body_key
+        return self.client.post("/rest/water/{}/".format(client_id), json.dumps(body),
+                                content_type="application/json", **headers)
+
+    def test_retry_is_replayed(self):
+        first = self.log_water("idempotent-header", HTTP_IDEMPOTENCY_KEY="retry-1")
+        retry = self.log_water("idempotent-header", HTTP_IDEMPOTENCY_KEY="retry-1")
+
+        self.assertEqual((first.status_code, retry.status_code), (200, 200))
+        self.assertEqual(Entry.objects.filter(user_id="idempotent-header").count(), 1)
+
+    def test_key_in_body(self):
+        self.log_water("idempotent-body", body_key="retry-2")
+        self.log_water("idempotent-body", body_key="retry-2")
+
+        self.assertEqual(Entry.objects.filter(user_id="idempotent-body").count(), 1)
+
+    def test_replayed_by_another_worker(self):
+        self.log_water("idempotent-worker", HTTP_IDEMPOTENCY_KEY="retry-3")
+        # Another worker's memory cache doesn't have the response, but the IdempotentResponse table does
+        response_cache.clear()
+        self.log_water("idempotent-worker", HTTP_IDEMPOTENCY_KEY="retry-3")
+
+        self.assertEqual(Entry.objects.filter(user_id="idempotent-worker").count(), 1)
+
+    def test_different_requests_are_handled(self):
+        self.log_water("idempotent-other", HTTP_IDEMPOTENCY_KEY="retry-4")
+        # The same key for another user, a different key, and no key at all
+        self.log_water("idempotent-other-2", HTTP_IDEMPOTENCY_KEY="retry-4")
+        self.log_water("idempotent-other", HTTP_IDEMPOTENCY_KEY="retry-5")
+        self.log_water("idempotent-other")
+
+        self.assertEqual(Entry.objects.filter(user_id="idempotent-other").count(), 3)
+        self.assertEqual(Entry.objects.filter(user_id="idempotent-other-2").count(), 1)
+
+    def claim_as_another_worker(self, client_id, key, age=0):
+        """
+        Insert the placeholder another worker handling the request would have, age seconds ago.
+        :return: The placeholder row
+        """
+        req_id = request_key(RequestFactory().post("/rest/water/{}/".format(client_id)), key)
+        return IdempotentResponse.objects.create(request_id=req_id, status_code=IN_PROGRESS, content_type="",
+                                                 content="", created_at=datetime.now() - timedelta(seconds=age))
+
+    @override_settings(IDEMPOTENCY_WAIT=0.2)
+    def test_waits_for_another_worker(self):
+        placeholder = self.claim_as_another_worker("idempotent-wait", "retry-7")
+
+        self.assertEqual(self.log_water("idempotent-wait", HTTP_IDEMPOTENCY_KEY="retry-7").status_code, 409)
+
+        # The other worker finishes, and the retry gets its response
+        placeholder.status_code = 201
+        placeholder.save()
+        self.assertEqual(self.log_water("idempotent-wait", HTTP_IDEMPOTENCY_KEY="retry-7").status_code, 201)
+        self.assertFalse(Entry.objects.filter(user_id="idempotent-wait").exists())
+
+    def test_abandoned_claim_is_taken_over(self):
+        self.claim_as_another_worker("idempotent-abandoned", "retry-8", age=120)
+
+        self.assertEqual(self.log_water("idempotent-abandoned", HTTP_IDEMPOTENCY_KEY="retry-8").status_code, 200)
+        self.assertEqual(Entry.objects.filter(user_id="idempotent-abandoned").count(), 1)
+        self.assertEqual(IdempotentResponse.objects.get().status_code, 200)
+
+    def test_server_errors_are_not_stored(self):
+        statuses = [500, 200]
+
+        @idempotent
+        def view(request):
+            return HttpResponse(status=statuses.pop(0))
+
+        factory = RequestFactory()
+        responses = [view(factory.post("/rest/flaky/", "{}", content_type="application/json",
+                                       HTTP_IDEMPOTENCY_KEY="retry-6")) for _ in range(3)]
+
+        self.assertEqual([response.status_code for response in responses], [500, 200, 200])
+        self.assertEqual(IdempotentResponse.objects.count(), 1)
+
+
+class SchemaTestCase(SimpleTestCase):
+    def test_valid_bodies(self):
+        self.assertEqual(log_food_body({"food_name": "banana", "serving": 120.5, "unknown": 1}),
+                         {"food_name": "banana", "serving": 120.5})
+        self.assertEqual(goals_body({"water_ml": 2000}), {"water_ml": 2000})
+        self.assertEqual(create_meal_body({"meal_name": "breakfast", "food_details": {"food1": {"name": "egg"}}}),
+                         {"meal_name": "breakfast", "food_details": {"food1": {"name": "egg"}}})
+
+    def test_invalid_bodies(self):
+        cases = [
+            (log_food_body, ["banana"], "body must be a JSON object"),
+            (log_food_body, {}, "food_name is required"),
+            (log_food_body, {"food_name": "  "}, "food_name must be a non-empty string"),
+            (log_food_body, {"food_name": "b" * 101}, "food_name must be at most 100 characters"),
+            (log_food_body, {"food_name": "banana", "serving": "120"}, "serving must be a number"),
+            (log_food_body, {"food_name": "banana", "serving": True}, "serving must be a number"),
+            (log_food_body, {"food_name": "banana", "serving": float("nan")}, "serving must be a number"),
+            (log_food_body, {"food_name": "banana", "serving": 0}, "serving must be a number between 1 and 10000"),
+            (goals_body, {}, "body must have at least one of water_ml, fat_grams, protein_grams, carb_grams"),
+            (create_meal_body, {"meal_name": "m", "food_details": {}}, "food_details must be a non-empty object"),
+            (create_meal_body, {"meal_name": "m", "food_details": {"food1": {"serving": 1}}}, "name is required"),
+            (create_meal_body, {"meal_name": "m", "food_details": {str(i): {"name": "egg"} for i in range(51)}},
+             "food_details must have at most 50 values"),
+        ]
+        for validate, body, error in cases:
+            with self.subTest(body=body):
+                with self.assertRaisesMessage(SchemaError, error):
+                    validate(body)
+
+
+class RejectedBodyTestCase(TestCase):
+    def test_invalid_body_is_a_400(self):
+        for body in ["not json", json.dumps({"water_ml": "lots"})]:
+            with self.subTest(body=body):
+                response = self.client.post("/rest/water/rejected-body/", body, content_type="application/json")
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", json.loads(response.content.decode("utf-8")))
+
+        self.assertFalse(Users.objects.filter(user_id="rejected-body").exists())
+
+
+class KnownFoodFilterTestCase(TransactionTestCase):
+    """
+    The known food filter is built on a background thread, and lookups go to the database until it's ready.
+    A TransactionTestCase, so the thread building the filter can see the rows the test stored.
+    """
+    def setUp(self):
+        self.wait_for_build()
+        utils._known_food_filter = None
+        utils._known_food_filter_started_at = None
+
+    def wait_for_build(self):
+        deadline = time.monotonic() + 10
+        while utils._known_food_filter_building and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(utils._known_food_filter_building)
+
+    def test_built_in_background(self):
+        banana_id = utils.food_key("banana")
+        FoodCache.objects.create(food_id=banana_id, food_name="banana", kilocalories=89, fat_grams=0,
+                                 carb_grams=23, protein_grams=1, fetched_at=datetime.now())
+
+        # Nothing is known yet, so the lookup goes to the database instead of waiting for the filter
+        self.assertEqual(utils.get_food("banana").food_id, banana_id)
+
+        self.wait_for_build()
+        food_filter = utils.known_food_filter()
+        self.assertIn(banana_id, food_filter)
+        self.assertNotIn(utils.food_key("bacon"), food_filter)
+
+    def test_foods_stored_during_a_build_are_kept(self):
+        release = threading.Event()
+        original_count = FoodCache.objects.count
+
+        def slow_count():
+            release.wait()
+            return original_count()
+
+        with mock.patch.object(FoodCache.objects, "count", slow_count):
+            self.assertIsNone(utils.known_food_filter())
+            utils.remember_known_foods(utils.food_key("egg"))
+            release.set()
+            self.wait_for_build()
+
+        self.assertIn(utils.food_key("egg"), utils.known_food_filter())
@@ -25,6 +25,7 @@ urlpatterns = [
     url(r'^create_meal/(?P<client_id>.+?)/$', views.create_meal),  # POST create a meal
     url(r'^log_meal/(?P<client_id>.+?)/$', views.log_meal),  # POST log a meal
     url(r'^log_food/(?P<client_id>.+?)/$', views.log_food),  # POST log a food
+    url(r'^log_batch/(?P<client_id>.+?)/$', views.log_batch),  # POST log several foods, meals and water at once
     url(r'^points/(?P<client_id>.+?)/$', views.points),  # GET points
     url(r'^today/(?P<client_id>.+?)/$', views.today_info),  # GET info about today's consumption
 
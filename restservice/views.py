@@ -1,20 +1,42 @@
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status
-from rest_framework.parsers import JSONParser
-from rest_framework.renderers import JSONRenderer
 
+from restservice.schemas import *
 from restservice.serializers import *
+from utility.idempotency import idempotent
+from utility.jsonencode import encode_json
+from utility.nutritics import FoodNotFoundError, NutriticsError
+from utility.schema import SchemaError, parse_body
 from utility.utils import *
 
 
 class JSONResponse(HttpResponse):
     def __init__(self, data, **kwargs):
-        content = JSONRenderer().render(data)
+        content = encode_json(data)
         kwargs['content_type'] = 'application/json'
         super(JSONResponse, self).__init__(content, **kwargs)
 
 
+def bad_request(error):
+    """
+    :return: A 400 response saying why the request body was rejected
+    """
+    return JSONResponse({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def food_lookup_failed(error):
+    """
+    :param error: The FoodNotFoundError or NutriticsError a food lookup raised
+    :return: A 404 response if Nutritics has no match for the food, or a 503 if Nutritics is failing (or its
+             circuit breaker is open, see NutriticsClient), saying why the food couldn't be looked up
+    """
+    if isinstance(error, FoodNotFoundError):
+        return JSONResponse({"error": str(error)}, status=status.HTTP_404_NOT_FOUND)
+
+    return JSONResponse({"error": str(error)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
 """
 All request handling functions take two parameters: request and client_id
 
@@ -33,7 +55,7 @@ def username(request, client_id):
     }
     """
     if request.method == 'GET':
-        user_obj = get_or_create_user_and_goals(client_id)[0]
+        user_obj = get_or_create_user_and_goals(client_id, cached=True)[0]
         response = {"username": user_obj.name}
 
         return JSONResponse(response, status=status.HTTP_200_OK)
@@ -42,6 +64,7 @@ def username(request, client_id):
 
 
 @csrf_exempt
+@idempotent
 def log_food(request, client_id):
     """
     Gets a JSON object from the client defining the food's name, and optionally the serving size used.
@@ -57,25 +80,30 @@ def log_food(request, client_id):
 
     """
     if request.method == 'POST':
-        user, user_goals = get_or_create_user_and_goals(client_id)
+        try:
+            food_entry_json = parse_body(request, log_food_body)
+        except SchemaError as e:
+            return bad_request(e)
 
-        food_entry_json = JSONParser().parse(request)
-        if "food_name" in food_entry_json:
-            food_name = food_entry_json["food_name"]
-            serving = food_entry_json["serving"] if "serving" in food_entry_json else user.serving_size
-        else:
-            return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+        user, user_goals = get_or_create_user_and_goals(client_id)
 
+        food_name = food_entry_json["food_name"]
+        serving = food_entry_json["serving"] if "serving" in food_entry_json else user.serving_size
         serving = serving / 100
 
-        food_data = get_food(food_name)
+        try:
+            food_data = get_food(food_name)
+        except (FoodNotFoundError, NutriticsError) as e:
+            return food_lookup_failed(e)
 
         curr_datetime = datetime.now()
 
         try:
             # Create food entry
-            Entry.objects.create(
-                entry_id=md5_hash_string(str(client_id) + str(curr_datetime)),
+            log_entry(
+                user,
+                user_goals,
+                entry_id=new_entry_id(),
                 user_id=user,
                 time_of_creation=curr_datetime,
                 entry_name=food_name,
@@ -87,8 +115,6 @@ def log_food(request, client_id):
                 water_ml=0,
                 is_water=False
             )
-
-            update_points_sprint_checkin(user, user_goals, curr_datetime)
             return HttpResponse(status=status.HTTP_200_OK)
 
         except Exception as e:
@@ -101,6 +127,7 @@ def log_food(request, client_id):
 
 
 @csrf_exempt
+@idempotent
 def log_meal(request, client_id):
     """
     Log an existing meal (a meal exists if it is in the MealCache). If the meal does not exist, throws a 400 BAD REQUEST
@@ -112,13 +139,13 @@ def log_meal(request, client_id):
     }
     """
     if request.method == 'POST':
-        user, user_goals = get_or_create_user_and_goals(client_id)
+        try:
+            meal_data = parse_body(request, log_meal_body)
+        except SchemaError as e:
+            return bad_request(e)
 
-        meal_data = JSONParser().parse(request)
-        if "meal_name" in meal_data:
-            meal_name = meal_data["meal_name"]
-        else:
-            return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+        user, user_goals = get_or_create_user_and_goals(client_id)
+        meal_name = meal_data["meal_name"]
 
         try:
             meal = get_meal(user, meal_name)
@@ -131,8 +158,10 @@ def log_meal(request, client_id):
         try:
 
             # Create meal entry
-            Entry.objects.create(
-                entry_id=md5_hash_string(str(user.user_id) + str(curr_datetime)),
+            log_entry(
+                user,
+                user_goals,
+                entry_id=new_entry_id(),
                 user_id=user,
                 time_of_creation=curr_datetime,
                 entry_name=meal_name,
@@ -144,8 +173,6 @@ def log_meal(request, client_id):
                 water_ml=0
             )
 
-            update_points_sprint_checkin(user, user_goals, curr_datetime)
-
             return HttpResponse(status=status.HTTP_200_OK)
         except Exception as e:
             print("Entry creation failed: meal")
@@ -159,6 +186,7 @@ def log_meal(request, client_id):
 def create_meal(request, client_id):
     """
     Create a meal and add it to the MealCache. A meal belongs to a specific user, and is associated with
+    any number of foods, which are all looked up together.
 
     Example JSON structure:
     {
@@ -176,28 +204,30 @@ def create_meal(request, client_id):
     }
     """
     if request.method == 'POST':
+        try:
+            meal_data = parse_body(request, create_meal_body)
+        except SchemaError as e:
+            return bad_request(e)
+
         user, user_goals = get_or_create_user_and_goals(client_id)
-        meal_data = JSONParser().parse(request)
         meal_name = meal_data["meal_name"]
         food_details = meal_data["food_details"]
         mb = utils.MealBuilder(meal_name, user)
 
-        # Iterate through the food items in the JSON
-        for food_title in utilconstants.FOOD_ENUM:
-            if food_title in food_details:
-                food = food_details[food_title]
+        # Collect every food item in the JSON, then look them all up at once
+        foods = []
+        for food in food_details.values():
+            if "serving" in food:
+                serving_size = food["serving"]
+            else:
+                serving_size = user.serving_size
 
-                if "name" in food:
-                    food_name = food["name"]
-                else:
-                    return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+            foods.append((food["name"], serving_size))
 
-                if "serving" in food:
-                    serving_size = food["serving"]
-                else:
-                    serving_size = user.serving_size
-
-                mb.add_food(food_name, serving_size)
+        try:
+            mb.add_foods(foods)
+        except (FoodNotFoundError, NutriticsError) as e:
+            return food_lookup_failed(e)
 
         try:
             mb.create_meal_record()
@@ -213,6 +243,7 @@ def create_meal(request, client_id):
 
 
 @csrf_exempt
+@idempotent
 def log_water(request, client_id):
     """
     Log some amount of water.
@@ -224,24 +255,23 @@ def log_water(request, client_id):
     """
 
     if request.method == 'POST':
-        user, user_goals = get_or_create_user_and_goals(client_id)
+        try:
+            water_data = parse_body(request, log_water_body)
+        except SchemaError as e:
+            return bad_request(e)
 
-        water_data = JSONParser().parse(request)
-        if "water_ml" in water_data:
-            water_ml = water_data["water_ml"]
-        else:
-            return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+        user, user_goals = get_or_create_user_and_goals(client_id)
+        water_ml = water_data["water_ml"]
 
         curr_datetime = datetime.now()
 
         # Create water entry
-        id_hash = md5_hash_string(user.user_id.__str__() + curr_datetime.__str__())
-        print(id_hash)
-
         try:
 
-            Entry.objects.create(
-                entry_id=id_hash,
+            log_entry(
+                user,
+                user_goals,
+                entry_id=new_entry_id(),
                 user_id_id=user.user_id,
                 time_of_creation=curr_datetime,
                 entry_name="water",
@@ -254,8 +284,6 @@ def log_water(request, client_id):
                 is_water=True
             )
 
-            update_points_sprint_checkin(user, user_goals, curr_datetime)
-
             return HttpResponse(status=status.HTTP_200_OK)
 
         except Exception as e:
@@ -266,6 +294,157 @@ def log_water(request, client_id):
     return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
 
 
+@csrf_exempt
+@idempotent
+def log_batch(request, client_id):
+    """
+    Log several foods, meals and water at once ("I had eggs, toast, coffee and a glass of water").
+    The foods are looked up together, all the entries are inserted at once, and the user's points and streak
+    are updated once. Each item gets its own result, so one bad item doesn't fail the others.
+
+    Expects a JSON in the following format, with 1 to 50 items, where each item looks like the body of log_food,
+    log_meal or log_water, plus a "type":
+    {
+        "items": [
+            {"type": "food", "food_name": "eggs", "serving": 120},
+            {"type": "food", "food_name": "toast"},
+            {"type": "meal", "meal_name": "bacon and eggs"},
+            {"type": "water", "water_ml": 250}
+        ]
+    }
+
+    Returns a JSON with one result per item, in the same order. Each status is what the single item
+    endpoint would have returned:
+    {
+        "results": [
+            {"status": 200},
+            {"status": 200},
+            {"status": 403, "error": "meal does not exist"},
+            {"status": 200}
+        ]
+    }
+    """
+    if request.method == 'POST':
+        try:
+            batch_data = parse_body(request, log_batch_body)
+        except SchemaError as e:
+            return bad_request(e)
+
+        # Validate every item against the body of its single item endpoint. Invalid items become None
+        items = []
+        for item in batch_data["items"]:
+            # An unknown type, or one that isn't a string (so can't be looked up), makes the item invalid
+            validate = None
+            if isinstance(item, dict) and isinstance(item.get("type"), str):
+                validate = batch_item_bodies.get(item["type"])
+            try:
+                items.append(dict(validate(item), type=item["type"]) if validate is not None else None)
+            except SchemaError:
+                items.append(None)
+
+        user, user_goals = get_or_create_user_and_goals(client_id)
+        results = [None] * len(items)
+
+        # Look all the foods up at once
+        food_names = [item["food_name"] for item in items if item is not None and item["type"] == "food"]
+        food_errors = dict()
+        foods = get_foods(food_names, errors=food_errors)
+
+        curr_datetime = datetime.now()
+        entries = []
+        entry_items = []
+
+        for i, item in enumerate(items):
+            item_type = item["type"] if item is not None else None
+
+            if item_type == "food":
+                food_name = item["food_name"]
+                if food_name not in foods:
+                    error = food_errors.get(food_name)
+                    if isinstance(error, FoodNotFoundError):
+                        results[i] = dict(status=status.HTTP_404_NOT_FOUND, error="food not found")
+                    elif isinstance(error, NutriticsError):
+                        results[i] = dict(status=status.HTTP_503_SERVICE_UNAVAILABLE, error="food lookup failed")
+                    else:
+                        print("Food lookup failed: {}".format(error))
+                        results[i] = dict(status=status.HTTP_500_INTERNAL_SERVER_ERROR, error="food lookup failed")
+                    continue
+
+                food_data = foods[food_name]
+                serving = (item["serving"] if "serving" in item else user.serving_size) / 100
+                entry = Entry(
+                    entry_id=new_entry_id(),
+                    user_id=user,
+                    time_of_creation=curr_datetime,
+                    entry_name=food_name,
+                    is_meal=False,
+                    kilocalories=food_data.kilocalories*serving,
+                    fat_grams=food_data.fat_grams*serving,
+                    carb_grams=food_data.carb_grams*serving,
+                    protein_grams=food_data.protein_grams*serving,
+                    water_ml=0,
+                    is_water=False
+                )
+
+            elif item_type == "meal":
+                try:
+                    meal = get_meal(user, item["meal_name"])
+                except ObjectDoesNotExist:
+                    results[i] = dict(status=status.HTTP_403_FORBIDDEN, error="meal does not exist")
+                    continue
+
+                entry = Entry(
+                    entry_id=new_entry_id(),
+                    user_id=user,
+                    time_of_creation=curr_datetime,
+                    entry_name=item["meal_name"],
+                    is_meal=True,
+                    kilocalories=meal.kilocalories,
+                    fat_grams=meal.fat_grams,
+                    protein_grams=meal.protein_grams,
+                    carb_grams=meal.carb_grams,
+                    water_ml=0
+                )
+
+            elif item_type == "water":
+                entry = Entry(
+                    entry_id=new_entry_id(),
+                    user_id=user,
+                    time_of_creation=curr_datetime,
+                    entry_name="water",
+                    is_meal=False,
+                    kilocalories=0,
+                    fat_grams=0,
+                    protein_grams=0,
+                    carb_grams=0,
+                    water_ml=item["water_ml"],
+                    is_water=True
+                )
+
+            else:
+                results[i] = dict(status=status.HTTP_400_BAD_REQUEST, error="invalid item")
+                continue
+
+            entries.append(entry)
+            entry_items.append(i)
+
+        try:
+            log_entries(user, user_goals, entries)
+            entry_status = dict(status=status.HTTP_200_OK)
+        except Exception as e:
+            print("Entry creation failed: batch")
+            print(e.__class__.__name__)
+            print(e)
+            entry_status = dict(status=status.HTTP_500_INTERNAL_SERVER_ERROR, error="entry creation failed")
+
+        for i in entry_items:
+            results[i] = dict(entry_status)
+
+        return JSONResponse({"results": results}, status=status.HTTP_200_OK)
+
+    return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+
+
 @csrf_exempt
 def goals(request, client_id):
     """
@@ -283,9 +462,8 @@ def goals(request, client_id):
             "fat_grams": 30
         }
         """
-        user, user_goals = get_or_create_user_and_goals(client_id)
-        goals_serializer = GoalsSerializer(user_goals)
-        return JSONResponse(goals_serializer.data, status=status.HTTP_200_OK)
+        user, user_goals = get_or_create_user_and_goals(client_id, cached=True)
+        return JSONResponse(goals_fields(user_goals), status=status.HTTP_200_OK)
 
     if request.method == 'PUT':
         """
@@ -304,8 +482,12 @@ def goals(request, client_id):
             "water_ml": 3000
         }
         """
+        try:
+            raw_goal_data = parse_body(request, goals_body)
+        except SchemaError as e:
+            return bad_request(e)
+
         user, user_goals = get_or_create_user_and_goals(client_id)
-        raw_goal_data = JSONParser().parse(request)
 
         for goal_param in utilconstants.GOAL_PARAM_NAMES:
             if goal_param in raw_goal_data:
@@ -313,6 +495,7 @@ def goals(request, client_id):
                 setattr(user_goals, goal_param, param)
 
         user_goals.save()
+        bump_user_version(client_id)
         return HttpResponse(status=status.HTTP_200_OK)
 
     return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
@@ -327,12 +510,8 @@ def points(request, client_id):
     }
     """
     if request.method == 'GET':
-        user_obj = get_or_create_user_and_goals(client_id)[0]
-        user_serializer = UserSerializer(user_obj)
-        # create new dict with just points data
-        data = {"points": user_serializer.data["points"]}
-
-        return JSONResponse(data, status=status.HTTP_200_OK)
+        user_obj = get_or_create_user_and_goals(client_id, cached=True)[0]
+        return JSONResponse(user_points_fields(user_obj), status=status.HTTP_200_OK)
 
     return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
 
@@ -350,7 +529,7 @@ def today_info(request, client_id):
     }
     """
     if request.method == 'GET':
-        user = get_or_create_user_and_goals(client_id)[0]
+        user = get_or_create_user_and_goals(client_id, cached=True)[0]
 
         today_data = get_today_macros(user)
 
@@ -376,15 +555,13 @@ def food_info(request, client_id, food_name):
 
     """
     if request.method == 'GET':
-        get_or_create_user_and_goals(client_id)
+        get_or_create_user_and_goals(client_id, cached=True)
 
         try:
             food_cache_obj = get_food(food_name)
-            food_cache_serializer = FoodCacheSerializer(food_cache_obj)
-            return JSONResponse(food_cache_serializer.data, status=status.HTTP_200_OK)
+            return JSONResponse(food_cache_fields(food_cache_obj), status=status.HTTP_200_OK)
 
-        except RuntimeError:
-            # This happens if the Nutritics API call in get_food() fails
-            return HttpResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except (FoodNotFoundError, NutriticsError) as e:
+            return food_lookup_failed(e)
 
     return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
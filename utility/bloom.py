@@ -0,0 +1,80 @@
+import math
+import threading
+
+"""
+Compact probabilistic set membership.
+"""
+
+
+class BloomFilter:
+    """
+    Bloom filter over MD5 hex digests (the format of every FoodCache / FoodAlias ID).
+
+    "key not in filter" is always right: the key was never added. "key in filter" may be a false positive,
+    at a rate of about error_rate once capacity keys have been added. Callers that find out a positive was
+    false can report it with record_false_positive(), so the observed rate can be compared to the estimate.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        :param capacity: The number of keys the filter is sized for
+        :param error_rate: The false positive rate wanted once capacity keys have been added
+        """
+        capacity = max(1, capacity)
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.checks = 0
+        self.negatives = 0
+        self.false_positives = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        # An MD5 digest is already uniformly distributed, so split it into two 64 bit halves and use
+        # double hashing instead of hashing the key num_hashes times
+        h1 = int(key[:16], 16)
+        h2 = int(key[16:32], 16) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        """
+        :param key: A 32 character MD5 hex digest
+        """
+        with self._lock:
+            for pos in self._positions(key):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        self.checks += 1
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                self.negatives += 1
+                return False
+        return True
+
+    def record_false_positive(self):
+        self.false_positives += 1
+
+    def estimated_false_positive_rate(self):
+        """
+        :return: The expected false positive rate, given how many keys have been added
+        """
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    def stats(self):
+        """
+        :return: A dictionary of the filter's size and check / false positive counters
+        """
+        positives = self.checks - self.negatives
+        return dict(
+            keys=self.count,
+            size_bytes=len(self.bits),
+            num_hashes=self.num_hashes,
+            checks=self.checks,
+            definite_misses=self.negatives,
+            false_positives=self.false_positives,
+            false_positive_rate=(self.false_positives / positives) if positives else 0.0,
+            estimated_false_positive_rate=self.estimated_false_positive_rate(),
+        )
@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+
+"""
+Reading nutrition datasets (CSV or NDJSON, per 100g values), for pre-seeding the food caches.
+
+Every record needs a name and per-100g kilocalories, fat, carbohydrate and protein values. The columns / keys
+may be called either the FoodCache field names or the Nutritics attribute names:
+    name | food_name
+    kilocalories | energyKcal | kcal
+    fat_grams | fat
+    carb_grams | carbohydrate | carbs
+    protein_grams | protein
+"""
+
+FIELD_ALIASES = {
+    "food_name": ("food_name", "name"),
+    "kilocalories": ("kilocalories", "energyKcal", "kcal"),
+    "fat_grams": ("fat_grams", "fat"),
+    "carb_grams": ("carb_grams", "carbohydrate", "carbs"),
+    "protein_grams": ("protein_grams", "protein"),
+}
+
+
+def guess_format(path):
+    """
+    :return: "csv" if path looks like a CSV file, "ndjson" otherwise
+    """
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def read_dataset(f, data_format):
+    """
+    Lazily read the records in a dataset, one at a time.
+    :param f: The open dataset file
+    :param data_format: "csv" or "ndjson"
+    :return: A generator of (record number, dict) pairs
+    """
+    if data_format == "csv":
+        records = csv.DictReader(f)
+    else:
+        records = (json.loads(line) for line in f if line.strip())
+
+    return enumerate(records, start=1)
+
+
+def open_dataset(path):
+    return io.open(path, encoding="utf-8", newline="")
+
+
+def parse_record(record):
+    """
+    Pull the food's name and macros out of one dataset record.
+    Raises KeyError, TypeError or ValueError if the record is missing a value or has one that isn't a number.
+    :return: A dict with food_name, kilocalories, fat_grams, carb_grams and protein_grams. Macros are rounded to ints
+    """
+    values = dict()
+    for field, names in FIELD_ALIASES.items():
+        value = next((record[name] for name in names if record.get(name) not in (None, "")), None)
+        if value is None:
+            raise KeyError(field)
+        # Nutritics style {"val": ...} objects are accepted too
+        if isinstance(value, dict):
+            value = value["val"]
+        values[field] = value
+
+    food_name = str(values.pop("food_name")).strip()
+    if not food_name:
+        raise ValueError("empty food name")
+
+    food = {field: int(round(float(value))) for field, value in values.items()}
+    food["food_name"] = food_name[:100]
+    return food
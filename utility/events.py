@@ -0,0 +1,45 @@
+import threading
+
+"""
+In-process change notifications, used to wake up streams waiting for a user's data to change.
+"""
+
+
+class EventHub:
+    """
+    Lets threads wait, without polling, until something happens to a key (e.g. a user logs an entry).
+
+    Each key has a counter that notify() increments. A waiter passes the last counter value it saw, and
+    wait() returns as soon as the counter moves past it, or when the timeout runs out. Only notifications
+    made in this process are seen; changes made by other workers have to be noticed some other way.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._counters = dict()
+
+    def current(self, key):
+        """
+        :return: The key's counter, to pass to wait() later
+        """
+        with self._condition:
+            return self._counters.get(key, 0)
+
+    def notify(self, key):
+        """
+        Wake up every thread waiting on key.
+        """
+        with self._condition:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, key, seen, timeout):
+        """
+        Block until key is notified after seen, or timeout seconds pass.
+        :param key: The key to wait on
+        :param seen: The counter value the caller last saw
+        :param timeout: The maximum number of seconds to wait
+        :return: The key's counter. It's equal to seen if the wait timed out
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._counters.get(key, 0) != seen, timeout)
+            return self._counters.get(key, 0)
@@ -0,0 +1,208 @@
+import json
+import hashlib
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpResponse
+
+from restservice.models import IdempotentResponse
+from utility.lrucache import LRUCache
+from utility.singleflight import SingleFlight
+
+"""
+Idempotency keys for the logging endpoints, so a retried request isn't logged twice.
+"""
+
+IDEMPOTENCY_HEADER = "HTTP_IDEMPOTENCY_KEY"   # The Idempotency-Key request header
+IDEMPOTENCY_FIELD = "idempotency_key"         # ...or this field in the JSON body
+
+# Recent responses, keyed by request_key(). Backed by the IdempotentResponse table, so a retry handled by
+# another worker still gets the original response
+response_cache = LRUCache(
+    max_size=getattr(settings, "IDEMPOTENCY_CACHE_MAX_SIZE", 4096),
+    ttl=getattr(settings, "IDEMPOTENCY_TTL", 3600)
+)
+
+# Makes a retry that arrives while the original request is still being handled wait for it, instead of running again
+request_flight = SingleFlight()
+
+# The status_code of the placeholder IdempotentResponse row a request claims before it's handled, so a retry handled
+# by another worker at the same time waits for it instead of running again
+IN_PROGRESS = 0
+
+# How often a retry checks whether the request it's waiting on has finished
+POLL_INTERVAL = 0.1
+
+# Expired rows are deleted once every PRUNE_EVERY stored responses
+PRUNE_EVERY = 100
+_stored = 0
+
+
+def idempotency_key(request):
+    """
+    :return: The idempotency key sent with the request, from the Idempotency-Key header or the body, or None
+    """
+    key = request.META.get(IDEMPOTENCY_HEADER)
+    if key:
+        return key
+
+    try:
+        # Reading request.body keeps a copy, so the view can still parse the request afterwards
+        body = json.loads(request.body.decode("utf-8"))
+    except ValueError:
+        return None
+
+    key = body.get(IDEMPOTENCY_FIELD) if isinstance(body, dict) else None
+    return str(key) if key else None
+
+
+def request_key(request, key):
+    """
+    :return: The ID a response is stored under. Scoped by path, so a key can't replay another user or endpoint
+    """
+    return hashlib.md5((request.path + key).encode()).hexdigest()
+
+
+def idempotent(view):
+    """
+    Decorator for POST views. The response to the first request carrying an idempotency key is stored, and
+    requests repeating the key within IDEMPOTENCY_TTL get that response back without the view running again.
+    Requests without a key, and server errors (which should be retried for real), aren't stored.
+
+    A retry that arrives while the first request is still being handled, by any worker, waits up to
+    IDEMPOTENCY_WAIT seconds for its response, and gets a 409 if it still isn't ready.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != "POST":
+            return view(request, *args, **kwargs)
+
+        key = idempotency_key(request)
+        if key is None:
+            return view(request, *args, **kwargs)
+
+        req_id = request_key(request, key)
+        stored = response_cache.get(req_id)
+        if stored is None:
+            stored = request_flight.do(req_id, respond_once, req_id, view, request, *args, **kwargs)
+
+        return HttpResponse(stored["content"], status=stored["status_code"], content_type=stored["content_type"])
+
+    return wrapper
+
+
+def respond_once(req_id, view, request, *args, **kwargs):
+    """
+    Return the stored response for req_id, or claim req_id and run the view and store its response. If another
+    worker holds the claim, wait for its response.
+    :return: A dictionary with the response's status_code, content_type and content
+    """
+    deadline = time.monotonic() + getattr(settings, "IDEMPOTENCY_WAIT", 10)
+
+    while True:
+        row = stored_response(req_id)
+        if row is not None:
+            response_cache.set(req_id, row)
+            return row
+
+        if claim(req_id):
+            break
+
+        if time.monotonic() >= deadline:
+            # Not stored, so a later retry gets the real response once it's ready
+            return dict(
+                status_code=409,
+                content_type="application/json",
+                content=json.dumps({"error": "a request with this idempotency key is still being handled"})
+            )
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        response = view(request, *args, **kwargs)
+    except Exception:
+        release(req_id)
+        raise
+
+    stored = dict(
+        status_code=response.status_code,
+        content_type=response.get("Content-Type", "text/html; charset=utf-8"),
+        content=response.content.decode("utf-8")
+    )
+
+    if response.status_code < 500:
+        store_response(req_id, stored)
+    else:
+        release(req_id)
+
+    return stored
+
+
+def stored_response(req_id):
+    """
+    :return: The stored response for req_id, as a dictionary of status_code, content_type and content, or None if
+             there's none (or the request is still being handled)
+    """
+    ttl = getattr(settings, "IDEMPOTENCY_TTL", 3600)
+    return IdempotentResponse.objects\
+        .filter(request_id=req_id, created_at__gte=datetime.now() - timedelta(seconds=ttl))\
+        .exclude(status_code=IN_PROGRESS)\
+        .values("status_code", "content_type", "content")\
+        .first()
+
+
+def claim(req_id):
+    """
+    Insert an IN_PROGRESS placeholder row for req_id, so other workers know the request is being handled. An expired
+    response, or a placeholder older than IDEMPOTENCY_CLAIM_TIMEOUT (its worker must have died), is taken over.
+    :return: True if this request now holds req_id, False if another request does or its response is stored
+    """
+    now = datetime.now()
+    try:
+        # A savepoint, so a failed insert doesn't break a surrounding transaction
+        with transaction.atomic():
+            IdempotentResponse.objects.create(request_id=req_id, status_code=IN_PROGRESS, content_type="",
+                                              content="", created_at=now)
+        return True
+    except IntegrityError:
+        pass
+
+    ttl = getattr(settings, "IDEMPOTENCY_TTL", 3600)
+    claim_timeout = getattr(settings, "IDEMPOTENCY_CLAIM_TIMEOUT", 60)
+    # Only one of the requests racing to take the row over updates it
+    taken_over = IdempotentResponse.objects.filter(request_id=req_id).filter(
+        Q(created_at__lt=now - timedelta(seconds=ttl)) |
+        Q(status_code=IN_PROGRESS, created_at__lt=now - timedelta(seconds=claim_timeout))
+    ).update(status_code=IN_PROGRESS, content_type="", content="", created_at=now)
+    return taken_over == 1
+
+
+def release(req_id):
+    """
+    Give up the claim on req_id without storing a response, so a retry runs the view again.
+    """
+    IdempotentResponse.objects.filter(request_id=req_id, status_code=IN_PROGRESS).delete()
+
+
+def store_response(req_id, stored):
+    """
+    Save a response in the memory cache and the IdempotentResponse table, pruning expired rows now and then.
+    """
+    global _stored
+
+    response_cache.set(req_id, stored)
+
+    try:
+        # Fills in the placeholder claim() inserted
+        IdempotentResponse.objects.update_or_create(request_id=req_id, defaults=dict(created_at=datetime.now(), **stored))
+    except IntegrityError:
+        # Another worker stored the same request first
+        pass
+
+    _stored += 1
+    if _stored % PRUNE_EVERY == 0:
+        ttl = getattr(settings, "IDEMPOTENCY_TTL", 3600)
+        IdempotentResponse.objects.filter(created_at__lt=datetime.now() - timedelta(seconds=ttl)).delete()
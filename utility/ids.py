@@ -0,0 +1,163 @@
+import errno
+import fcntl
+import os
+import re
+import threading
+import time
+
+"""
+Compact, time-ordered unique IDs (Snowflake style), used as Entry primary keys.
+
+An ID is a 64 bit number, written as 13 Crockford base32 characters so that IDs sort as strings in the order
+they were made:
+    42 bits   milliseconds since ID_EPOCH_MS
+    10 bits   worker ID
+    12 bits   sequence number within the millisecond
+"""
+
+ID_EPOCH_MS = 1514764800000   # 2018-01-01 00:00:00 UTC
+
+TIMESTAMP_BITS = 42
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Reserved for IDs made offline (e.g. by the migrate_entry_ids command), never given to a live worker
+OFFLINE_WORKER_ID = MAX_WORKER_ID
+
+ID_LENGTH = 13
+CROCKFORD_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def encode_id(number):
+    """
+    :return: number as ID_LENGTH Crockford base32 characters
+    """
+    chars = []
+    for _ in range(ID_LENGTH):
+        chars.append(CROCKFORD_ALPHABET[number & 31])
+        number >>= 5
+    return "".join(reversed(chars))
+
+
+def compose_id(timestamp_ms, worker_id, sequence):
+    """
+    :param timestamp_ms: Milliseconds since the Unix epoch
+    :return: The encoded ID for the given parts
+    """
+    number = ((timestamp_ms - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | sequence
+    return encode_id(number)
+
+
+def default_worker_base(workers_per_host):
+    """
+    The first worker ID of this dyno, worked out from its DYNO name. The worker IDs below OFFLINE_WORKER_ID are
+    split into ranges of workers_per_host, and the last eighth of the ranges is kept for one-off and other non-web
+    dynos (run.N, release.N, worker.N...), so they never share a range with a web dyno. web.1 gets range 0, web.2
+    range 1 and so on, wrapping around if there are more web dynos than ranges. Other dynos get one of their ranges
+    by their number. 0 off Heroku.
+    """
+    ranges = OFFLINE_WORKER_ID // workers_per_host
+    match = re.match(r"(\w+)\.(\d+)$", os.environ.get("DYNO", ""))
+    if match is None or ranges < 2:
+        return 0
+
+    other_ranges = max(1, ranges // 8)
+    web_ranges = ranges - other_ranges
+    dyno_type, number = match.group(1), int(match.group(2))
+
+    if dyno_type == "web":
+        return ((number - 1) % web_ranges) * workers_per_host
+    return (web_ranges + number % other_ranges) * workers_per_host
+
+
+def claim_worker_slot(directory, slots):
+    """
+    Claim a slot no other live process on this machine holds, with an flock() on a file in directory. The slot
+    stays claimed until the process exits (the lock file is deliberately never closed).
+    :param directory: The directory the lock files live in
+    :param slots: The number of slots
+    :return: The claimed slot, between 0 and slots - 1
+    """
+    os.makedirs(directory, exist_ok=True)
+    for slot in range(slots):
+        lock_file = open(os.path.join(directory, "worker-{}.lock".format(slot)), "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            lock_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            continue
+        _claimed_slots.append(lock_file)
+        return slot
+
+    raise RuntimeError("All {} ID worker slots in {} are taken".format(slots, directory))
+
+
+# Lock files of claimed slots, kept open for the life of the process
+_claimed_slots = []
+
+
+class IdGenerator:
+    """
+    Thread-safe generator of time-ordered IDs. IDs from one generator are strictly increasing, even if the
+    system clock goes backwards. Up to 4096 IDs are made per millisecond before waiting for the next one.
+
+    Every process making IDs needs its own worker ID, or two processes can make the same ID in the same
+    millisecond. Each process claims one the first time it makes an ID, so forked gunicorn workers get
+    different ones.
+    """
+    def __init__(self, worker_id=None, worker_base=None, workers_per_host=16, lock_dir=None):
+        """
+        :param worker_id: A fixed number between 0 and MAX_WORKER_ID identifying this generator. Only safe if no
+                          other process uses the same one (e.g. OFFLINE_WORKER_ID for offline commands)
+        :param worker_base: If worker_id isn't given, each process gets worker_base plus a slot claimed on this
+                            machine (see claim_worker_slot()). Defaults to default_worker_base()
+        :param workers_per_host: The number of slots, i.e. processes on one machine that can make IDs at once
+        :param lock_dir: The directory the slots' lock files live in
+        """
+        if worker_id is not None and not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError("worker_id must be between 0 and {}".format(MAX_WORKER_ID))
+
+        if worker_id is None:
+            if worker_base is None:
+                worker_base = default_worker_base(workers_per_host)
+            if worker_base < 0 or worker_base + workers_per_host > OFFLINE_WORKER_ID:
+                raise ValueError("Worker IDs {} to {} must be between 0 and {}".format(
+                    worker_base, worker_base + workers_per_host - 1, OFFLINE_WORKER_ID - 1))
+            if lock_dir is None:
+                raise ValueError("lock_dir is needed to claim a worker ID")
+
+        self._fixed_worker_id = worker_id
+        self._worker_base = worker_base
+        self._workers_per_host = workers_per_host
+        self._lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker_id = worker_id
+        self._last_ms = 0
+        self._sequence = 0
+
+    def new_id(self):
+        with self._lock:
+            if self._fixed_worker_id is None and self._pid != os.getpid():
+                # First call in this process (gunicorn --preload forks after this module is imported)
+                self._pid = os.getpid()
+                self._worker_id = self._worker_base + claim_worker_slot(self._lock_dir, self._workers_per_host)
+
+            now_ms = max(int(time.time() * 1000), self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence used up for this millisecond
+                    while now_ms <= self._last_ms:
+                        time.sleep(0.0001)
+                        now_ms = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+
+            self._last_ms = now_ms
+            return compose_id(now_ms, self._worker_id, self._sequence)
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Bounded in-process caches, shared by every request handled by a single worker.
+"""
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a per-entry time to live.
+
+    Entries are evicted when the cache grows past max_size (least recently used first), or lazily
+    when they are read after their TTL has expired. Hit / miss / eviction counters are kept so the
+    cache's effectiveness can be inspected with stats().
+    """
+    def __init__(self, max_size=1024, ttl=300):
+        """
+        :param max_size: The maximum number of entries held at once
+        :param ttl: The number of seconds an entry stays valid for. None means entries never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key, or default if it is missing or has expired.
+        """
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value under key, evicting the least recently used entries if the cache is full.
+        :param ttl: Overrides the cache's default TTL for this entry only
+        """
+        if self.max_size <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drop the entry stored under key, if there is one.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Drop every entry. Counters are left untouched.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return: A dictionary of the cache's size and hit / miss / eviction counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                size=len(self._data),
+                max_size=self.max_size,
+                ttl=self.ttl,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+                hit_rate=(self.hits / lookups) if lookups else 0.0,
+            )
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,65 @@
+import re
+import unicodedata
+
+"""
+Normalization of food and meal names, so different phrasings of the same food share a cache key.
+"""
+
+ARTICLES = {"a", "an", "the", "some", "one"}
+
+# Words that end in "s" but aren't plurals, or whose plural rules below would mangle them
+SINGULAR_EXCEPTIONS = {
+    "asparagus", "bass", "brussels", "citrus", "couscous", "molasses", "hummus", "swiss", "grits",
+    "oats", "chips", "lentils", "peas", "nachos", "tortellini", "pancreas", "series", "species",
+}
+
+# Singulars ending in "e" that the plural rules below would strip it from ("cookies" isn't "cooky")
+SINGULARS_ENDING_IN_E = {
+    "cookie", "pie", "brownie", "smoothie", "veggie", "hoagie", "pastie", "calorie", "quiche",
+    "brioche", "ganache", "sloe", "glaze",
+}
+
+_NON_WORD = re.compile(r"[^\w]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def singularize(word):
+    """
+    Very simple English singularization, good enough for food names ("bananas" -> "banana",
+    "berries" -> "berry", "tomatoes" -> "tomato", "peaches" -> "peach", "cookies" -> "cookie").
+    """
+    if len(word) <= 3 or word in SINGULAR_EXCEPTIONS:
+        return word
+    if word.endswith("es") and word[:-1] in SINGULARS_ENDING_IN_E:
+        return word[:-1]
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith("oes") or word.endswith(("ches", "shes", "sses", "xes", "zes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize_food_name(name):
+    """
+    Turn a food or meal name into its canonical form before it is hashed:
+        - Unicode and case folding ("Banana" -> "banana")
+        - Punctuation becomes whitespace, and whitespace is collapsed ("banana , ripe " -> "banana ripe")
+        - Leading articles are dropped ("a banana" -> "banana")
+        - The last word is singularized ("bananas" -> "banana")
+
+    :param name: The name as the user said it
+    :return: The normalized name. If normalizing would leave nothing, the stripped, case folded name is returned
+    """
+    folded = unicodedata.normalize("NFKC", name).casefold()
+    words = _WHITESPACE.split(_NON_WORD.sub(" ", folded).strip())
+
+    while len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+
+    if not words or not words[0]:
+        return folded.strip()
+
+    words[-1] = singularize(words[-1])
+    return " ".join(words)
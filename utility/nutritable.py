@@ -0,0 +1,166 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+
+"""
+Read-only, memory-mapped nutrition table: a local tier of per-100g nutrition data, built offline from a dataset
+with the build_nutrition_table command and consulted by get_food before asking Nutritics.
+
+File layout (all integers little-endian):
+    header    magic (8 bytes), record count (uint64), record size (uint32), name size (uint32), 8 reserved bytes
+    index     record count x uint64: the first 8 bytes of each record's food ID, as a big-endian number, sorted
+    records   record count x record size, in the same order as the index:
+              food ID (16 byte MD5 digest), kilocalories, fat, carb, protein (int32 each), name (UTF-8, NUL padded)
+
+The index lets lookups binary search a contiguous array of integers, and the file is only ever read through
+the mmap, so forked workers share the same pages.
+"""
+
+MAGIC = b"DASHNUT1"
+NAME_SIZE = 64
+HEADER = struct.Struct("<8sQII8x")
+INDEX_ENTRY = struct.Struct("<Q")
+RECORD = struct.Struct("<16s4i{}s".format(NAME_SIZE))
+
+
+def _index_key(food_id):
+    """
+    :param food_id: A 32 character MD5 hex digest (a food_key())
+    :return: The integer the index is sorted by
+    """
+    return int(food_id[:16], 16)
+
+
+class _PortableIndex:
+    """
+    Sequence view of the index for big-endian machines, where a native memoryview cast would read it wrong.
+    """
+    def __init__(self, buf, offset, count):
+        self._buf = buf
+        self._offset = offset
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return INDEX_ENTRY.unpack_from(self._buf, self._offset + i * INDEX_ENTRY.size)[0]
+
+
+class NutritionTable:
+    """
+    Reader for a nutrition table file. Lookups are a binary search over the mmapped index: O(log n), and no
+    reads of the records section except for the one record that matches.
+    """
+    def __init__(self, path):
+        """
+        :param path: The table file, as written by write_nutrition_table()
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, record_size, name_size = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or record_size != RECORD.size or name_size != NAME_SIZE:
+            self._mm.close()
+            raise ValueError("{} is not a nutrition table, or was built by an incompatible version".format(path))
+
+        index_end = HEADER.size + self.count * INDEX_ENTRY.size
+        if sys.byteorder == "little":
+            self._index = memoryview(self._mm)[HEADER.size:index_end].cast("Q")
+        else:
+            self._index = _PortableIndex(self._mm, HEADER.size, self.count)
+        self._records_offset = index_end
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, food_id):
+        """
+        :param food_id: A 32 character MD5 hex digest (a food_key())
+        :return: A dict with food_id, food_name, kilocalories, fat_grams, carb_grams and protein_grams,
+                 or None if the food isn't in the table
+        """
+        key = _index_key(food_id)
+        digest = bytes.fromhex(food_id)
+
+        i = bisect.bisect_left(self._index, key)
+        while i < self.count and self._index[i] == key:
+            offset = self._records_offset + i * RECORD.size
+            if self._mm[offset:offset + 16] == digest:
+                _, kcal, fat, carb, protein, name = RECORD.unpack_from(self._mm, offset)
+                self.hits += 1
+                return dict(
+                    food_id=food_id,
+                    food_name=name.rstrip(b"\0").decode("utf-8", "ignore"),
+                    kilocalories=kcal,
+                    fat_grams=fat,
+                    carb_grams=carb,
+                    protein_grams=protein
+                )
+            i += 1
+
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return dict(path=self.path, foods=self.count, hits=self.hits, misses=self.misses)
+
+    def close(self):
+        if isinstance(self._index, memoryview):
+            self._index.release()
+        self._mm.close()
+
+    def __len__(self):
+        return self.count
+
+
+def write_nutrition_table(path, foods):
+    """
+    Write a nutrition table file. The file is written next to path and renamed into place, so a table that
+    running workers have mapped is never modified underneath them.
+    :param path: Where to write the table
+    :param foods: An iterable of dicts with food_id (a food_key()), food_name, kilocalories, fat_grams,
+                  carb_grams and protein_grams. If a food_id appears more than once, the last one is kept
+    :return: The number of foods written
+    """
+    by_id = dict()
+    for food in foods:
+        by_id[food["food_id"]] = food
+
+    food_ids = sorted(by_id)   # Hex digests sort the same way as their bytes, and so as the index keys
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(food_ids), RECORD.size, NAME_SIZE))
+        for food_id in food_ids:
+            f.write(INDEX_ENTRY.pack(_index_key(food_id)))
+        for food_id in food_ids:
+            food = by_id[food_id]
+            name = food["food_name"].encode("utf-8")[:NAME_SIZE]
+            f.write(RECORD.pack(bytes.fromhex(food_id), food["kilocalories"], food["fat_grams"],
+                                food["carb_grams"], food["protein_grams"], name))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return len(food_ids)
+
+
+def load_nutrition_table(path):
+    """
+    Open the table at path. Returns None if path isn't set or the table can't be opened, so get_food
+    simply skips this tier.
+    """
+    if not path:
+        return None
+
+    try:
+        return NutritionTable(path)
+    except (OSError, ValueError) as e:
+        print("Could not open nutrition table {}".format(path))
+        print(e.__class__.__name__)
+        print(e)
+        return None
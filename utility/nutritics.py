@@ -0,0 +1,190 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utility import utilconstants as nc
+
+"""
+HTTP client for the Nutritics API.
+"""
+
+
+class NutriticsError(RuntimeError):
+    """
+    Raised when Nutritics can't be reached, or keeps failing after all retries.
+    """
+    pass
+
+
+class FoodNotFoundError(RuntimeError):
+    """
+    Raised when Nutritics answered, but has no match for the food that was searched for.
+    """
+    pass
+
+
+class CircuitOpenError(NutriticsError):
+    """
+    Raised instead of making a request while the circuit breaker is open.
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while, so callers fail fast instead of waiting on timeouts.
+
+    CLOSED: requests go through. After failure_threshold consecutive failures the breaker opens.
+    OPEN: requests are refused until reset_timeout seconds have passed, then the breaker goes half-open.
+    HALF_OPEN: a single trial request is let through. Success closes the breaker, failure opens it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        :return: True if a request may be made right now
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+
+            # Half-open: only one trial request at a time
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def seconds_until_retry(self):
+        """
+        :return: How long until the breaker will let a trial request through (0 if it isn't open)
+        """
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+
+class NutriticsClient:
+    """
+    Shared, pooled client for Nutritics. Keeps connections alive between requests, applies connect and read
+    timeouts, retries transient failures with jittered exponential backoff, and trips a circuit breaker
+    when Nutritics keeps failing.
+
+    base_url can be pointed at a local stub server for testing.
+    """
+    def __init__(self, base_url=nc.FOOD_BASE_URL, auth=(nc.NUTRITICS_USER, nc.NUTRITICS_PSWD),
+                 connect_timeout=3.05, read_timeout=10.0, max_retries=2, backoff=0.2,
+                 pool_size=10, breaker=None):
+        """
+        :param base_url: The URL food names are appended to
+        :param auth: (username, password) used for HTTP basic auth
+        :param connect_timeout: Seconds to wait for a TCP / TLS connection
+        :param read_timeout: Seconds to wait between bytes of the response
+        :param max_retries: How many times a failed request is retried (so at most max_retries + 1 attempts)
+        :param backoff: Base delay in seconds. Attempt n waits a random time between 0 and backoff * 2**n
+        :param pool_size: The maximum number of kept-alive connections
+        :param breaker: The CircuitBreaker to use. A default one is made if not given
+        """
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def build_food_url(self, food_name):
+        """
+        Build a request URL to get a single-item list from Nutritics for a food, with all macros for that food.
+        """
+        return self.base_url + food_name + nc.ALL_ATTRS + nc.LIMIT_ONE
+
+    def search_food(self, food_name):
+        """
+        :param food_name: The name of the food we're searching for
+        :return: The decoded JSON response from Nutritics
+        """
+        return self.get_json(self.build_food_url(food_name))
+
+    def get_json(self, url):
+        """
+        GET url and decode its JSON body, retrying failed requests (connection errors, timeouts, broken responses)
+        and 5xx responses.
+        Raises CircuitOpenError without making a request if the breaker is open, or NutriticsError once
+        the retries are used up.
+        """
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("Nutritics circuit breaker is open, retrying in {:.1f}s".format(
+                self.breaker.seconds_until_retry()))
+
+        # Every way out of here has to record a success or a failure, or a half-open breaker would wait forever
+        # for its trial request to finish
+        succeeded = False
+        try:
+            last_error = None
+            for attempt in range(self.max_retries + 1):
+                if attempt > 0:
+                    time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+                try:
+                    r = self.session.get(url, timeout=self.timeout)
+                    if r.status_code >= 500:
+                        last_error = NutriticsError("Nutritics returned HTTP {}".format(r.status_code))
+                        continue
+                    response = r.json()
+                except requests.RequestException as e:
+                    last_error = e
+                    continue
+                except ValueError as e:
+                    # Body wasn't JSON
+                    last_error = e
+                    continue
+
+                succeeded = True
+                return response
+
+            raise NutriticsError("Nutritics request failed after {} attempts: {}".format(
+                self.max_retries + 1, last_error))
+        finally:
+            if succeeded:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
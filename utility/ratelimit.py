@@ -0,0 +1,39 @@
+import threading
+import time
+
+"""
+Rate limiting helpers.
+"""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens are added continuously at rate per second, up to capacity, and each
+    permitted action takes one.
+    """
+    def __init__(self, rate, capacity):
+        """
+        :param rate: Tokens added per second
+        :param capacity: The most tokens that can be saved up, i.e. the largest burst allowed
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Take a token if one is available.
+        :return: True if a token was taken, False if the budget is used up for now
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
@@ -0,0 +1,140 @@
+import json
+
+"""
+Declarative validation of JSON request bodies. Schemas are compiled once, at import, into validator functions.
+"""
+
+
+class SchemaError(ValueError):
+    """
+    Raised when a request body isn't valid JSON, or doesn't match its schema. The message says what's wrong.
+    """
+    pass
+
+
+class Field:
+    """
+    Describes one key of a JSON object.
+    """
+    def __init__(self, kind, required=True, max_length=None, minimum=None, maximum=None, schema=None,
+                 values=None):
+        """
+        :param kind: "string", "number" (an int or float), "integer", "object_map" (an object whose every
+                     value is validated by schema) or "list" (an array, whose items are left to the caller)
+        :param required: Whether the key must be present
+        :param max_length: For strings, the longest allowed length (strings must also not be blank)
+        :param minimum: For numbers, the smallest allowed value
+        :param maximum: For numbers, the largest allowed value
+        :param schema: For object maps, a dictionary of key -> Field
+        :param values: For object maps and lists, the most values allowed
+        """
+        self.kind = kind
+        self.required = required
+        self.max_length = max_length
+        self.minimum = minimum
+        self.maximum = maximum
+        self.schema = schema
+        self.values = values
+
+
+def _compile_field(key, field):
+    """
+    :return: A function that checks and returns a value for key, raising SchemaError if it doesn't match field
+    """
+    if field.kind == "string":
+        max_length = field.max_length
+
+        def check(value):
+            if not isinstance(value, str) or not value.strip():
+                raise SchemaError("{} must be a non-empty string".format(key))
+            if max_length is not None and len(value) > max_length:
+                raise SchemaError("{} must be at most {} characters".format(key, max_length))
+            return value
+
+    elif field.kind in ("number", "integer"):
+        types = int if field.kind == "integer" else (int, float)
+        minimum = field.minimum if field.minimum is not None else float("-inf")
+        maximum = field.maximum if field.maximum is not None else float("inf")
+        kind = "an integer" if field.kind == "integer" else "a number"
+        out_of_range = "{} must be {} between {} and {}".format(key, kind, field.minimum, field.maximum)
+
+        def check(value):
+            # bool is a subclass of int, but true isn't a quantity. value != value catches NaN
+            if not isinstance(value, types) or isinstance(value, bool) or value != value:
+                raise SchemaError("{} must be {}".format(key, kind))
+            if not minimum <= value <= maximum:
+                raise SchemaError(out_of_range)
+            return value
+
+    elif field.kind == "object_map":
+        validate = compile_schema(field.schema, name=key + " values")
+        max_values = field.values
+
+        def check(value):
+            if not isinstance(value, dict) or not value:
+                raise SchemaError("{} must be a non-empty object".format(key))
+            if max_values is not None and len(value) > max_values:
+                raise SchemaError("{} must have at most {} values".format(key, max_values))
+            return {item_key: validate(item) for item_key, item in value.items()}
+
+    elif field.kind == "list":
+        max_values = field.values
+
+        def check(value):
+            if not isinstance(value, list) or not value:
+                raise SchemaError("{} must be a non-empty list".format(key))
+            if max_values is not None and len(value) > max_values:
+                raise SchemaError("{} must have at most {} values".format(key, max_values))
+            return value
+
+    else:
+        raise ValueError("Unknown field kind {}".format(field.kind))
+
+    return check
+
+
+def compile_schema(schema, name="body", require_any=False):
+    """
+    Compile a schema into a validator. Keys that aren't in the schema are ignored (and left out of the result).
+
+    :param schema: A dictionary of key -> Field
+    :param name: What the validated object is called in error messages
+    :param require_any: If True, no key is required on its own, but at least one must be present
+    :return: A function taking the decoded JSON and returning a dictionary of the schema's keys that were present,
+             or raising SchemaError
+    """
+    checks = tuple((key, field.required and not require_any, _compile_field(key, field))
+                   for key, field in schema.items())
+    keys = ", ".join(schema)
+
+    def validate(data):
+        if not isinstance(data, dict):
+            raise SchemaError("{} must be a JSON object".format(name))
+
+        cleaned = dict()
+        for key, required, check in checks:
+            if key in data:
+                cleaned[key] = check(data[key])
+            elif required:
+                raise SchemaError("{} is required".format(key))
+
+        if require_any and not cleaned:
+            raise SchemaError("{} must have at least one of {}".format(name, keys))
+        return cleaned
+
+    return validate
+
+
+def parse_body(request, validate):
+    """
+    Decode a request's JSON body and validate it.
+    :param request: The Django request
+    :param validate: A validator made by compile_schema()
+    :return: The validated body
+    """
+    try:
+        data = json.loads(request.body.decode("utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        raise SchemaError("body must be valid JSON")
+
+    return validate(data)
@@ -0,0 +1,111 @@
+import errno
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Helpers for making sure a piece of expensive work is only done once at a time, per key.
+"""
+
+
+class _Call:
+    """
+    An in-flight call that other threads can wait on.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key within this process.
+
+    The first thread to ask for a key (the leader) runs the function. Every other thread that asks for
+    the same key while the leader is running waits for it, and gets the leader's result (or exception).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) unless a call for key is already in flight, in which case wait for that one.
+        :param key: Identifies the piece of work being done
+        :param fn: The function to call if this thread becomes the leader
+        :return: The return value of fn
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        """
+        :return: The number of keys currently being worked on
+        """
+        with self._lock:
+            return len(self._calls)
+
+
+@contextmanager
+def file_lease(directory, key, timeout=10.0, poll_interval=0.05):
+    """
+    Hold an exclusive, cross-process lease on key for the duration of the with block.
+
+    The lease is an flock() on a small file in directory, so every worker on the same machine sharing that
+    directory is coordinated. If the lease can't be acquired within timeout seconds the block runs anyway
+    (the caller must still cope with a race), and False is yielded instead of True.
+
+    :param directory: The directory the lock files live in
+    :param key: Name of the lease. Must be safe to use as a file name (e.g. an MD5 hex string)
+    :param timeout: The maximum number of seconds to wait for the lease
+    :param poll_interval: Seconds to sleep between attempts
+    """
+    os.makedirs(directory, exist_ok=True)
+    lock_file = open(os.path.join(directory, key + ".lock"), "a")
+    acquired = False
+
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+                break
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if time.monotonic() >= deadline:
+                    print("Could not acquire lease {} after {}s, continuing without it".format(key, timeout))
+                    break
+                time.sleep(poll_interval)
+
+        yield acquired
+
+    finally:
+        if acquired:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
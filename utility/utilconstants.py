@@ -12,5 +12,3 @@ CARBS_ATTR = "&attr=name,carbohydrate"
 LIMIT_ONE = "&limit=1"
 
 GOAL_PARAM_NAMES = ["water_ml", "fat_grams", "protein_grams", "carb_grams"]
-
-FOOD_ENUM = ["food1", "food2", "food3", "food4", "food5"]
@@ -1,15 +1,123 @@
-import requests
 from utility import utilconstants as nc
+from utility.bloom import BloomFilter
+from utility.events import EventHub
+from utility.ids import IdGenerator
+from utility.lrucache import LRUCache
+from utility.normalize import normalize_food_name
+from utility.nutritable import load_nutrition_table
+from utility.nutritics import NutriticsClient, CircuitBreaker, FoodNotFoundError
+from utility.ratelimit import TokenBucket
+from utility.singleflight import SingleFlight, file_lease
+from utility.writebehind import WriteBehindBuffer
 from restservice.models import *
 import hashlib
+import os
+import threading
+import time as monotonic_time
 import monsterurl
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.signals import request_started
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, post_delete
 from datetime import datetime, timedelta, time
+from concurrent.futures import ThreadPoolExecutor
 
 """
 File for general utility functions and classes.
 """
 
+# Per-worker memory cache in front of the FoodCache table, keyed by food_key()
+food_memory_cache = LRUCache(
+    max_size=getattr(settings, "FOOD_MEMORY_CACHE_MAX_SIZE", 2048),
+    ttl=getattr(settings, "FOOD_MEMORY_CACHE_TTL", 3600)
+)
+
+# Names Nutritics has no match for, keyed by food_key(), so they aren't searched for again until the TTL runs out
+unknown_food_cache = LRUCache(
+    max_size=getattr(settings, "FOOD_NEGATIVE_CACHE_MAX_SIZE", 4096),
+    ttl=getattr(settings, "FOOD_NEGATIVE_CACHE_TTL", 600)
+)
+
+# Bloom filter of every FoodCache / FoodAlias ID, built in the background by build_known_food_filter().
+# IDs stored while a build is running are kept in _known_foods_during_build and added to the new filter
+_known_food_filter = None
+_known_food_filter_started_at = None
+_known_food_filter_building = False
+_known_foods_during_build = []
+_known_food_filter_lock = threading.Lock()
+
+# When this worker last logged its food cache stats (see log_food_cache_stats())
+_food_stats_logged_at = monotonic_time.monotonic()
+_food_stats_lock = threading.Lock()
+
+# Read-only, memory-mapped nutrition table consulted before Nutritics. Opened at import time, so with
+# gunicorn --preload every worker shares the master's mapping
+nutrition_table = load_nutrition_table(getattr(settings, "NUTRITION_TABLE_PATH", None))
+
+# Per-worker cache of (user, goals) pairs for read-only handlers, keyed by client_id
+user_cache = LRUCache(
+    max_size=getattr(settings, "USER_CACHE_MAX_SIZE", 1024),
+    ttl=getattr(settings, "USER_CACHE_TTL", 30)
+)
+
+# Per-worker caches of user name -> user_id (which never changes) and user_id -> data_version,
+# so a revalidated insights page needs no database work
+user_name_cache = LRUCache(
+    max_size=getattr(settings, "USER_CACHE_MAX_SIZE", 1024),
+    ttl=None
+)
+user_version_cache = LRUCache(
+    max_size=getattr(settings, "USER_CACHE_MAX_SIZE", 1024),
+    ttl=getattr(settings, "USER_VERSION_TTL", 5)
+)
+
+# Wakes up this worker's insights streams when a user's data changes, keyed by user_id
+user_events = EventHub()
+
+# Generates time-ordered Entry IDs for this worker
+entry_id_generator = IdGenerator(
+    worker_base=getattr(settings, "ENTRY_ID_WORKER_BASE", None),
+    workers_per_host=getattr(settings, "ENTRY_ID_WORKERS_PER_HOST", 16),
+    lock_dir=settings.ENTRY_ID_LOCK_DIR
+)
+
+# Coalesces concurrent FoodCache misses for the same food_key() within this worker
+food_flight = SingleFlight()
+
+# Background refreshes of stale FoodCache rows. The thread pool is started lazily, so it isn't created
+# in the gunicorn master before the workers fork
+food_refresh_budget = TokenBucket(
+    rate=getattr(settings, "FOOD_REFRESH_PER_MINUTE", 30) / 60,
+    capacity=getattr(settings, "FOOD_REFRESH_PER_MINUTE", 30)
+)
+_refresh_pool = None
+_refreshing_foods = set()
+_refresh_lock = threading.Lock()
+
+# Journal and background flusher for entries, used when ENTRY_INGESTION_MODE is "buffered"
+entry_buffer = WriteBehindBuffer(
+    directory=getattr(settings, "ENTRY_JOURNAL_DIR", "/tmp/dashserver-entry-journal"),
+    flush_fn=lambda records, committed: write_journaled_entries(records, committed),
+    flush_interval=getattr(settings, "ENTRY_FLUSH_INTERVAL", 1),
+    flush_size=getattr(settings, "ENTRY_FLUSH_SIZE", 200)
+)
+
+# Shared, pooled Nutritics client for this worker
+nutritics_client = NutriticsClient(
+    base_url=getattr(settings, "NUTRITICS_BASE_URL", None) or nc.FOOD_BASE_URL,
+    connect_timeout=getattr(settings, "NUTRITICS_CONNECT_TIMEOUT", 3.05),
+    read_timeout=getattr(settings, "NUTRITICS_READ_TIMEOUT", 10),
+    max_retries=getattr(settings, "NUTRITICS_MAX_RETRIES", 2),
+    pool_size=getattr(settings, "NUTRITICS_POOL_SIZE", 10),
+    breaker=CircuitBreaker(
+        failure_threshold=getattr(settings, "NUTRITICS_BREAKER_THRESHOLD", 5),
+        reset_timeout=getattr(settings, "NUTRITICS_BREAKER_RESET", 30)
+    )
+)
+
 
 class MealBuilder:
     """
@@ -22,8 +130,8 @@ class MealBuilder:
         self.carb = 0
         self.protein = 0
         self.fat = 0
-        # Generates a meal ID using the MD5 hash, based on the name of the meal and the user's ID
-        self.meal_id = md5_hash_string(meal_name + user.user_id)
+        # Generates a meal ID using the MD5 hash, based on the normalized name of the meal and the user's ID
+        self.meal_id = meal_key(meal_name, user.user_id)
 
     def add_food(self, food_name, serving_size=0):
         """
@@ -32,8 +140,23 @@ class MealBuilder:
         :param serving_size: The serving size to scale the food to. If left unchanged (default 0)
                 then the default serving size for the user is used
         """
-        food = get_food(food_name)
+        self._add_scaled(get_food(food_name), serving_size)
+
+    def add_foods(self, foods):
+        """
+        Adds several Foods to the meal at once. Foods that aren't cached yet are looked up on Nutritics
+        concurrently (see get_foods), so this takes about as long as the slowest single lookup.
+        :param foods: A list of (food_name, serving_size) tuples. A serving_size of 0 means the user's default
+        """
+        food_objs = get_foods([food_name for food_name, _ in foods])
 
+        for food_name, serving_size in foods:
+            self._add_scaled(food_objs[food_name], serving_size)
+
+    def _add_scaled(self, food, serving_size):
+        """
+        Scale a FoodCache record to serving_size and add it to the meal's macros.
+        """
         # Get scale factor
         if serving_size == 0:
             scale = self.user.serving_size / 100
@@ -75,96 +198,651 @@ def get_meal(user, meal_name):
     :param meal_name: The name of the meal
     :return: The named meal object associated to the given user
     """
-    meal_id = md5_hash_string(meal_name + user.user_id)
-    meal = MealCache.objects.get(meal_id=meal_id)
-    return meal
+    try:
+        return MealCache.objects.get(meal_id=meal_key(meal_name, user.user_id))
+    except ObjectDoesNotExist:
+        # Meals created before names were normalized are stored under the hash of the raw name
+        return MealCache.objects.get(meal_id=md5_hash_string(meal_name + user.user_id))
+
+
+def meal_key(meal_name, user_id):
+    """
+    :return: The MealCache ID for a user's meal: the MD5 hash of the normalized meal name and the user's ID
+    """
+    return md5_hash_string(normalize_food_name(meal_name) + user_id)
+
+
+def food_key(food_name):
+    """
+    :return: The FoodCache / FoodAlias ID for a food: the MD5 hash of its normalized name
+    """
+    return md5_hash_string(normalize_food_name(food_name))
+
+
+def lookup_cached_food(food_id):
+    """
+    Get a food from the FoodCache by its ID, following the FoodAlias table if the ID is an alias.
+    Throws an ObjectDoesNotExist Exception if neither table knows about the food.
+    :param food_id: A food_key()
+    :return: A FoodCacheRecord
+    """
+    try:
+        return FoodCache.objects.get(food_id=food_id)
+    except ObjectDoesNotExist:
+        return FoodAlias.objects.select_related("food_id").get(alias_id=food_id).food_id
 
 
 def get_food(food_name):
     """
     Makes a request to get info for a certain food.
+    Checks this worker's memory cache first, then the FoodCache (and its aliases), then the local nutrition table,
+    and only then asks Nutritics.
     :param food_name: The name of the food
     :return: A FoodCacheRecord
     """
+    log_food_cache_stats()
+    food_id = food_key(food_name)
+
+    food_obj = food_memory_cache.get(food_id)
+    if food_obj is not None:
+        schedule_food_refresh(food_obj)
+        return food_obj
+
+    if unknown_food_cache.get(food_id):
+        raise FoodNotFoundError("Nutritics has no match for {}".format(food_name))
+
+    # If the filter says the food definitely isn't cached, skip straight to fetch_and_store_food(),
+    # which checks the database once more under its lease in case another worker just stored it.
+    # Until the filter has been built, every food might be cached
+    food_obj = None
+    food_filter = known_food_filter()
+    if food_filter is None or food_id in food_filter:
+        try:
+            food_obj = lookup_cached_food(food_id)
+            schedule_food_refresh(food_obj)
+        except ObjectDoesNotExist:
+            if food_filter is not None:
+                food_filter.record_false_positive()
+
+    if food_obj is None:
+        food_obj = lookup_table_food(food_id)
+
+    if food_obj is None:
+        # Waiting for whoever is already looking the food up can take seconds
+        release_db_connection()
+        food_obj = food_flight.do(food_id, fetch_and_store_food, food_name, food_id)
+
+    food_memory_cache.set(food_id, food_obj)
+    return food_obj
+
+
+def lookup_table_food(food_id):
+    """
+    Look a food up in the local nutrition table, if one is configured.
+    :param food_id: A food_key()
+    :return: An unsaved FoodCacheRecord, or None if there's no table or the food isn't in it
+    """
+    if nutrition_table is None:
+        return None
+
+    food_dict = nutrition_table.lookup(food_id)
+    if food_dict is None:
+        return None
+
+    return FoodCache(**food_dict)
+
+
+def get_foods(food_names, errors=None):
+    """
+    Batch version of get_food. Foods in the memory cache are used as is, the rest are fetched from the
+    FoodCache and FoodAlias tables in one query each, then the local nutrition table is checked, and anything
+    still missing is looked up concurrently on a bounded thread pool. Each of those lookups goes through
+    fetch_and_store_food() under the same key and lease as get_food(), so a concurrent get_food() of the same
+    food, in this worker or another one, doesn't ask Nutritics again.
+
+    Raises the first lookup error (a RuntimeError) if any food couldn't be found, unless errors is given.
+    :param food_names: A list of food names. Duplicates are only looked up once
+    :param errors: If a dict is given, lookup errors are stored in it (food name -> exception) instead of
+                   being raised, and the foods that couldn't be found are left out of the result
+    :return: A dict that maps each food name to its FoodCacheRecord
+    """
+    log_food_cache_stats()
+    food_ids = dict()
+    for food_name in food_names:
+        food_ids[food_name] = food_key(food_name)
+
+    found = dict()
+    for food_name, food_id in food_ids.items():
+        food_obj = food_memory_cache.get(food_id)
+        if food_obj is not None:
+            found[food_name] = food_obj
+            schedule_food_refresh(food_obj)
+
+    failed = dict()
+    for food_name, food_id in food_ids.items():
+        if food_name not in found and unknown_food_cache.get(food_id):
+            failed[food_name] = FoodNotFoundError("Nutritics has no match for {}".format(food_name))
+
+    if failed and errors is None:
+        raise next(iter(failed.values()))
+
+    food_ids = {food_name: food_id for food_name, food_id in food_ids.items() if food_name not in failed}
+
+    food_filter = known_food_filter()
+    missing = [food_name for food_name in food_ids if food_name not in found]
+    maybe_cached_ids = [food_ids[food_name] for food_name in missing
+                        if food_filter is None or food_ids[food_name] in food_filter]
+    if maybe_cached_ids:
+        rows = FoodCache.objects.in_bulk(maybe_cached_ids)
+        for alias in FoodAlias.objects.select_related("food_id").filter(alias_id__in=maybe_cached_ids):
+            rows[alias.alias_id] = alias.food_id
+
+        for food_name in missing:
+            if food_ids[food_name] in rows:
+                found[food_name] = rows[food_ids[food_name]]
+                food_memory_cache.set(food_ids[food_name], found[food_name])
+                schedule_food_refresh(found[food_name])
+            elif food_filter is not None and food_ids[food_name] in maybe_cached_ids:
+                food_filter.record_false_positive()
+
+    for food_name in food_ids:
+        if food_name not in found:
+            food_obj = lookup_table_food(food_ids[food_name])
+            if food_obj is not None:
+                found[food_name] = food_obj
+                food_memory_cache.set(food_ids[food_name], food_obj)
+
+    missing = [food_name for food_name in food_ids if food_name not in found]
+    if missing:
+        max_threads = getattr(settings, "FOOD_LOOKUP_THREADS", 8)
+        release_db_connection()
+        with ThreadPoolExecutor(max_workers=min(max_threads, len(missing))) as pool:
+            futures = [
+                pool.submit(fetch_on_pool_thread, food_name, food_ids[food_name])
+                for food_name in missing
+            ]
+            # Wait for all of them before raising, so no lookup is left running in the background
+            results = [(food_name, future.exception(), future) for food_name, future in zip(missing, futures)]
+
+        for food_name, error, future in results:
+            if error is not None:
+                if errors is None:
+                    raise error
+                failed[food_name] = error
+            else:
+                found[food_name] = future.result()
+                food_memory_cache.set(food_ids[food_name], found[food_name])
+
+    if errors is not None:
+        errors.update(failed)
+    return found
+
+
+def fetch_on_pool_thread(food_name, food_id):
+    """
+    get_foods()'s lookups of foods that aren't cached, run on its thread pool. Coalesced with get_food()'s lookups
+    of the same food.
+    :return: A FoodCacheRecord
+    """
     try:
-        food_obj = FoodCache.objects.get(food_id=md5_hash_string(food_name))
-    except ObjectDoesNotExist:
-        food_cache_dict = food_request(food_name)
-        food_obj = FoodCache.objects.create(
-            food_id=food_cache_dict["food_id"],
-            food_name=food_cache_dict["food_name"],
+        return food_flight.do(food_id, fetch_and_store_food, food_name, food_id)
+    finally:
+        # The pool's threads end with the batch, so their connections would be left open
+        connection.close()
+
+
+def release_db_connection():
+    """
+    Close this thread's database connection before waiting on something slow, like Nutritics, so the wait doesn't
+    hold one of the database's connections. Django opens a new one the next time it's needed.
+    Inside a transaction the connection is kept, since closing it would throw the transaction away.
+    """
+    if not connection.in_atomic_block:
+        connection.close()
+
+
+def fetch_and_store_food(food_name, food_id):
+    """
+    Ask Nutritics about a food and store the result in the FoodCache.
+
+    Only one worker on this machine does this for a given food at a time (see file_lease), and the FoodCache
+    is checked again once the lease is held, since another worker may have stored the food while we waited.
+    If some other server still wins the race to insert the row, its row is used instead of failing.
+    :param food_name: The name of the food
+    :param food_id: food_key(food_name)
+    :return: A FoodCacheRecord
+    """
+    lease_dir = settings.FOOD_LEASE_DIR
+    lease_timeout = getattr(settings, "FOOD_LEASE_TIMEOUT", 10)
+
+    with file_lease(lease_dir, food_id, timeout=lease_timeout):
+        try:
+            return lookup_cached_food(food_id)
+        except ObjectDoesNotExist:
+            pass
+
+        # The re-check above reopened this thread's connection. Don't hold it while Nutritics answers
+        release_db_connection()
+        try:
+            food_cache_dict = food_request(food_name)
+        except FoodNotFoundError:
+            unknown_food_cache.set(food_id, True)
+            raise
+
+        food_obj = store_food(food_cache_dict, food_id, food_name)
+        remember_known_foods(food_id, food_obj.food_id)
+        return food_obj
+
+
+def known_food_filter():
+    """
+    Get this worker's Bloom filter of every FoodCache and FoodAlias ID. The filter is built on a background thread
+    the first time it's asked for, and rebuilt every FOOD_FILTER_REFRESH seconds so it picks up foods that other
+    workers have stored, while the old one keeps being used. Foods stored by this worker are added straight away.
+    :return: A BloomFilter, or None until the first build has finished (every food may be cached until then)
+    """
+    global _known_food_filter_started_at, _known_food_filter_building
+
+    refresh = getattr(settings, "FOOD_FILTER_REFRESH", 3600)
+    now = monotonic_time.monotonic()
+
+    with _known_food_filter_lock:
+        stale = _known_food_filter_started_at is None or now - _known_food_filter_started_at >= refresh
+        if stale and not _known_food_filter_building:
+            _known_food_filter_started_at = now
+            _known_food_filter_building = True
+            del _known_foods_during_build[:]
+            threading.Thread(target=build_known_food_filter, daemon=True).start()
+
+        return _known_food_filter
+
+
+def build_known_food_filter():
+    """
+    Build a Bloom filter from the FoodCache and FoodAlias tables and swap it in as the known food filter.
+    Scanning a large table takes seconds, so this runs on its own thread (see known_food_filter()). If the build
+    fails, the old filter is kept until the next refresh.
+    """
+    global _known_food_filter, _known_food_filter_building
+
+    food_filter = None
+    try:
+        num_foods = FoodCache.objects.count() + FoodAlias.objects.count()
+        food_filter = BloomFilter(
+            capacity=max(getattr(settings, "FOOD_FILTER_CAPACITY", 100000), 2 * num_foods),
+            error_rate=getattr(settings, "FOOD_FILTER_ERROR_RATE", 0.01)
+        )
+        for food_id in FoodCache.objects.values_list("food_id", flat=True).iterator():
+            food_filter.add(food_id)
+        for alias_id in FoodAlias.objects.values_list("alias_id", flat=True).iterator():
+            food_filter.add(alias_id)
+
+    except Exception as e:
+        print("Building the known food filter failed")
+        print(e.__class__.__name__)
+        print(e)
+        food_filter = None
+
+    finally:
+        with _known_food_filter_lock:
+            if food_filter is not None:
+                # Foods stored during the scan may have been missed by it
+                for food_id in _known_foods_during_build:
+                    food_filter.add(food_id)
+                _known_food_filter = food_filter
+            _known_food_filter_building = False
+            del _known_foods_during_build[:]
+
+        # This thread's connection would otherwise stay open until the database drops it
+        connection.close()
+
+
+def remember_known_foods(*food_ids):
+    """
+    Add newly stored FoodCache / FoodAlias IDs to this worker's Bloom filter, and to the one being built, if any.
+    """
+    with _known_food_filter_lock:
+        food_filter = _known_food_filter
+        if _known_food_filter_building:
+            _known_foods_during_build.extend(food_ids)
+
+    if food_filter is not None:
+        for food_id in food_ids:
+            food_filter.add(food_id)
+
+
+def food_cache_stats():
+    """
+    :return: A dictionary of hit / miss / eviction / false positive counters for this worker's food caches
+    """
+    return dict(
+        memory_cache=food_memory_cache.stats(),
+        not_found_cache=unknown_food_cache.stats(),
+        known_food_filter=_known_food_filter.stats() if _known_food_filter is not None else None,
+    )
+
+
+def log_food_cache_stats():
+    """
+    Print this worker's food_cache_stats() once every FOOD_CACHE_STATS_INTERVAL seconds (0 turns it off), so the
+    hit, miss and false positive rates of every worker show up in the logs. Called on every food lookup, and only
+    prints when the interval has passed, so idle workers stay quiet.
+    """
+    global _food_stats_logged_at
+
+    interval = getattr(settings, "FOOD_CACHE_STATS_INTERVAL", 300)
+    now = monotonic_time.monotonic()
+    with _food_stats_lock:
+        if not interval or now - _food_stats_logged_at < interval:
+            return
+        _food_stats_logged_at = now
+
+    stats = food_cache_stats()
+    line = "Food cache stats (pid {}): memory cache {:.1%} hits of {} lookups, {} evictions; " \
+           "not found cache {:.1%} hits of {} lookups".format(
+               os.getpid(),
+               stats["memory_cache"]["hit_rate"],
+               stats["memory_cache"]["hits"] + stats["memory_cache"]["misses"],
+               stats["memory_cache"]["evictions"],
+               stats["not_found_cache"]["hit_rate"],
+               stats["not_found_cache"]["hits"] + stats["not_found_cache"]["misses"])
+    if stats["known_food_filter"] is not None:
+        line += "; known food filter {} checks, {} definite misses, {:.1%} false positives".format(
+            stats["known_food_filter"]["checks"],
+            stats["known_food_filter"]["definite_misses"],
+            stats["known_food_filter"]["false_positive_rate"])
+    print(line)
+
+
+def store_food(food_cache_dict, food_id, food_name):
+    """
+    Store a food returned by food_request() in the FoodCache, unless its canonical name is already cached.
+    If the name that was searched for isn't the canonical one, it is added to the FoodAlias table so the
+    next search for it is a cache hit.
+    :param food_cache_dict: The dictionary returned by food_request()
+    :param food_id: food_key() of the name that was searched for
+    :param food_name: The name that was searched for
+    :return: The FoodCacheRecord for the canonical food
+    """
+    try:
+        with transaction.atomic():
+            food_obj = FoodCache.objects.create(**food_cache_dict)
+    except IntegrityError:
+        food_obj = FoodCache.objects.get(food_id=food_cache_dict["food_id"])
+
+    if food_id != food_obj.food_id:
+        try:
+            with transaction.atomic():
+                FoodAlias.objects.create(alias_id=food_id, alias=normalize_food_name(food_name)[:100], food_id=food_obj)
+        except IntegrityError:
+            pass
+
+    return food_obj
+
+
+def is_stale(food_obj):
+    """
+    :return: True if a FoodCache row was fetched more than FOOD_STALE_AFTER_DAYS ago, or has no fetch time
+    """
+    if food_obj.fetched_at is None:
+        return True
+    return datetime.now() - food_obj.fetched_at > timedelta(days=getattr(settings, "FOOD_STALE_AFTER_DAYS", 30))
+
+
+def schedule_food_refresh(food_obj):
+    """
+    If a FoodCache row is stale, refresh it from Nutritics in the background. The caller carries on with the
+    stale row, so users never wait on Nutritics for a food that's already cached.
+    Refreshes are limited to FOOD_REFRESH_PER_MINUTE per worker, and a food is only refreshed once at a time.
+    Foods that aren't in the database (e.g. from the nutrition table) are never refreshed.
+    :param food_obj: A FoodCacheRecord
+    :return: True if a refresh was scheduled
+    """
+    global _refresh_pool
+
+    if food_obj._state.adding or not is_stale(food_obj):
+        return False
+
+    with _refresh_lock:
+        if food_obj.food_id in _refreshing_foods or not food_refresh_budget.try_acquire():
+            return False
+        _refreshing_foods.add(food_obj.food_id)
+
+        if _refresh_pool is None:
+            _refresh_pool = ThreadPoolExecutor(max_workers=getattr(settings, "FOOD_REFRESH_THREADS", 2))
+
+    _refresh_pool.submit(refresh_food, food_obj)
+    return True
+
+
+def refresh_food(food_obj):
+    """
+    Fetch a food's nutrition data from Nutritics again and update its FoodCache row. The cached object is
+    updated in place too, so every memory cache entry that points at it (including aliases) sees the new values.
+    Runs on the refresh thread pool; failures are logged and the stale row is kept. So is a row whose name
+    Nutritics now resolves to a different food.
+    :param food_obj: The stale FoodCacheRecord
+    """
+    try:
+        food_cache_dict = food_request(food_obj.food_name)
+        if food_cache_dict["food_id"] != food_obj.food_id:
+            # Nutritics' top hit is a different food (e.g. the row was imported, or predates canonical names), so
+            # its values aren't this food's. Keep them, but don't ask again until the row is stale again
+            print("Not refreshing food {} ({}): Nutritics returned {} instead".format(
+                food_obj.food_id, food_obj.food_name, food_cache_dict["food_name"]))
+            fetched_at = food_cache_dict["fetched_at"]
+            FoodCache.objects.filter(food_id=food_obj.food_id).update(fetched_at=fetched_at)
+            food_obj.fetched_at = fetched_at
+            return
+
+        fresh_values = dict(
             kilocalories=food_cache_dict["kilocalories"],
             fat_grams=food_cache_dict["fat_grams"],
             carb_grams=food_cache_dict["carb_grams"],
-            protein_grams=food_cache_dict["protein_grams"]
+            protein_grams=food_cache_dict["protein_grams"],
+            fetched_at=food_cache_dict["fetched_at"]
         )
+        FoodCache.objects.filter(food_id=food_obj.food_id).update(**fresh_values)
 
-    return food_obj
+        for field, value in fresh_values.items():
+            setattr(food_obj, field, value)
+
+    except Exception as e:
+        print("Refreshing food {} failed".format(food_obj.food_id))
+        print(e.__class__.__name__)
+        print(e)
 
+    finally:
+        with _refresh_lock:
+            _refreshing_foods.discard(food_obj.food_id)
+        # This thread's database connection isn't managed by a request, so close it here
+        connection.close()
 
-def food_request(food_name):
-    # Make request to Nutritics
-    r = requests.get(build_food_req_string(food_name), auth=(nc.NUTRITICS_USER, nc.NUTRITICS_PSWD))
 
-    response = r.json()
+def invalidate_cached_food(sender, instance, **kwargs):
+    """
+    Signal receiver that drops a FoodCache row from the memory cache whenever it is written or deleted.
+    Only this worker's cache is invalidated; other workers (and aliases of the food) pick up the change
+    when their entry's TTL runs out.
+    """
+    food_memory_cache.invalidate(instance.food_id)
+
+
+post_save.connect(invalidate_cached_food, sender=FoodCache, dispatch_uid="invalidate_cached_food_save")
+post_delete.connect(invalidate_cached_food, sender=FoodCache, dispatch_uid="invalidate_cached_food_delete")
+
+
+def food_request(food_name):
+    # Make request to Nutritics. Raises a NutriticsError (a RuntimeError) if Nutritics is unreachable,
+    # or a CircuitOpenError straight away if it has been failing recently.
+    # Nutritics is asked about the name as the user said it; the normalized name is only used for cache keys
+    search_name = food_name.strip()
+    response = nutritics_client.search_food(search_name)
     if response["status"] != 200:
-        raise RuntimeError("Nutritics query failed")
+        raise FoodNotFoundError("Nutritics has no match for {}".format(search_name))
 
-    food_hash = md5_hash_string(food_name)
     food_data = response["1"]
 
+    # The food is cached under the name Nutritics knows it by, so different phrasings share one record
+    canonical_name = food_data.get("name") or search_name
+
     food_cache_dict = dict(
-        food_id=food_hash,
-        food_name=food_name,
+        food_id=food_key(canonical_name),
+        food_name=canonical_name[:100],
         kilocalories=food_data["energyKcal"]["val"],
         protein_grams=food_data["protein"]["val"],
         carb_grams=food_data["carbohydrate"]["val"],
-        fat_grams=food_data["fat"]["val"]
+        fat_grams=food_data["fat"]["val"],
+        fetched_at=datetime.now()
     )
 
     return food_cache_dict
 
 
-def get_or_create_user_and_goals(client_id):
+def get_or_create_user_and_goals(client_id, cached=False):
     """
     NOTE: THIS FUNCTION HAS TO BE CALLED AT THE BEGINNING OF EVERY REQUEST-HANDLING FUNCTION IN THIS CLASS
     THERE ARE NO EXCEPTIONS TO THIS, OR IT'LL BREAK EVERYTHING
 
     Checks if the client already has a registered account, or if one needs to be made.
     Gets the account if it already exists, or makes a new one if it doesn't.
+
+    The user and their goals are fetched together in one query. Read-only handlers can pass cached=True to
+    use this worker's short-lived cache of the pair instead; handlers that write to the user or their goals
+    must not, since the cached copy may be up to USER_CACHE_TTL seconds behind other workers.
+    :param client_id: The client's unique ID token
+    :param cached: Whether a recently cached copy of the user and goals may be returned
+    :return: (user, goals)
     """
+    if cached:
+        user_and_goals = user_cache.get(client_id)
+        if user_and_goals is not None:
+            return user_and_goals
+
     try:
-        user_entry = Users.objects.get(user_id=client_id)
+        goal_entry = Goals.objects.select_related("user_id").get(user_id=client_id)
+        user_and_goals = (goal_entry.user_id, goal_entry)
     except ObjectDoesNotExist:
-        user_entry = Users.objects.create(
-            user_id=client_id,
-            name=monsterurl.get_monster(),
-            serving_size=100,
-            sprint=1,
-            points=0,
-            last_checkin=datetime.now()
-        )
+        user_and_goals = create_user_and_goals(client_id)
+
+    user_cache.set(client_id, user_and_goals)
+    return user_and_goals
+
+
+def create_user_and_goals(client_id):
+    """
+    Create a user and their default goals, or get whichever of them already exist.
+    Safe to call from concurrent requests for the same new client: whoever loses the race to insert a row
+    uses the winner's row.
+    :return: (user, goals)
+    """
+    for _ in range(5):
+        try:
+            with transaction.atomic():
+                user_entry = Users.objects.create(
+                    user_id=client_id,
+                    name=monsterurl.get_monster(),
+                    serving_size=100,
+                    sprint=1,
+                    points=0,
+                    last_checkin=datetime.now()
+                )
+        except IntegrityError:
+            # Either the user was created by another request, or the monster name is taken (so try another)
+            try:
+                user_entry = Users.objects.get(user_id=client_id)
+            except ObjectDoesNotExist:
+                continue
+
+        break
+    else:
+        raise IntegrityError("Could not find a free username for {}".format(client_id))
 
     try:
+        with transaction.atomic():
+            goal_entry = Goals.objects.create(
+                goal_id=md5_hash_string(client_id),
+                user_id=user_entry,
+                water_ml=3500,
+                protein_grams=50,
+                fat_grams=70,
+                carb_grams=310,
+                kilocalories=2070
+            )
+    except IntegrityError:
         goal_entry = Goals.objects.get(user_id=client_id)
-    except ObjectDoesNotExist:
-        goal_entry = Goals.objects.create(
-            goal_id=md5_hash_string(client_id),
-            user_id=user_entry,
-            water_ml=3500,
-            protein_grams=50,
-            fat_grams=70,
-            carb_grams=310,
-            kilocalories=2070
-        )
 
     return user_entry, goal_entry
 
 
-def calculate_points(user, user_goals):
+def invalidate_cached_user(client_id):
+    """
+    Drop a user and their goals from this worker's user cache. Call this after writing to either of them.
+    """
+    user_cache.invalidate(client_id)
+    user_version_cache.invalidate(client_id)
+
+
+def bump_user_version(client_id):
+    """
+    Mark the user's data as changed, so cached insights pages are no longer served. Entries bump the version as
+    part of update_points_sprint_checkin(); call this after other changes, e.g. to the user's goals.
+    """
+    Users.objects.filter(user_id=client_id).update(data_version=F("data_version") + 1)
+    notify_user_changed(client_id)
+
+
+def notify_user_changed(client_id):
+    """
+    Drop the user from this worker's caches and wake up their insights streams. Call once the change is committed,
+    so the streams read the new data.
+    """
+    invalidate_cached_user(client_id)
+    user_events.notify(client_id)
+
+
+def get_user_version(client_name, cached_only=False):
+    """
+    Get a user's ID and data_version from their name, from this worker's caches if possible.
+    The version may be up to USER_VERSION_TTL seconds behind changes made by other workers.
+    :param client_name: The client's monstrous username
+    :param cached_only: If True, return None instead of querying the database when they aren't cached
+    :return: (user_id, data_version)
+    """
+    user_id = user_name_cache.get(client_name)
+    version = user_version_cache.get(user_id) if user_id is not None else None
+
+    if version is None:
+        if cached_only:
+            return None
+
+        if user_id is None:
+            row = Users.objects.filter(name=client_name).values_list("user_id", "data_version").first()
+        else:
+            row = Users.objects.filter(user_id=user_id).values_list("user_id", "data_version").first()
+
+        if row is None:
+            raise ObjectDoesNotExist
+
+        user_id, version = row
+        remember_user_version(client_name, user_id, version)
+
+    return user_id, version
+
+
+def remember_user_version(client_name, user_id, version):
+    """
+    Cache a user's ID and data_version that were read from the database anyway, for get_user_version()
+    """
+    user_name_cache.set(client_name, user_id)
+    user_version_cache.set(user_id, version)
+
+
+def calculate_points(user, user_goals, entries):
     """
-    Return the total points awarded to the user for reaching daily goals.
-    Points are negative if goals are surpassed.
+    Return the points awarded to the user for logging entries, before they're multiplied by the user's sprint:
+    the change the entries make to the day's score (see day_score()). Points are negative if the entries move
+    them further past their goals. Summed over a day, the points awarded equal that day's score.
 
     The closer the user gets to their goals for today, the more points they're awarded.
     However, if they move past any of their targets, they should be penalised.
@@ -172,10 +850,13 @@ def calculate_points(user, user_goals):
 
     :param user: The user who's points should be calculated
     :param user_goals: The user's goals
+    :param entries: The list of Entries that were just logged, all on the same day (and already counted in the
+    day's totals)
 
     Workflow:
     User logs a food or meal entry. Entry gets posted into database.
-    Points awarded is a function of (todays_macros)/(user_goals)
+    Points awarded is a function of (todays_macros)/(user_goals), before and after the entries. Only the day's
+    totals row is read, so this costs the same however many entries the user has logged today.
 
     todays_macros_dict = dict(
         'carbs_grams' = carbs_g_today,
@@ -201,25 +882,14 @@ def calculate_points(user, user_goals):
     - Total points now: 150 - 5 = 145
     """
     try:
-        daily_macros_dict = get_today_macros(user, user.last_checkin)
+        after = get_today_macros(user, entries[0].time_of_creation, include_unflushed=False)
+        before = dict(after)
+        for entry in entries:
+            added = entry_macros(entry)
+            for macro in nc.GOAL_PARAM_NAMES:
+                before[macro] -= added[macro]
 
-        # if daily amounts consumed are over the goal limit, points are negative
-
-        water_points = daily_macros_dict['water_ml'] / user_goals.water_ml
-        water_points = int(water_points*100 if (0 < water_points <= 1) else (-water_points*100))
-
-        protein_points = daily_macros_dict['protein_grams'] / user_goals.protein_grams
-        protein_points = int(protein_points*100 if (0 < protein_points <= 1) else (-protein_points*100))
-
-        fat_points = daily_macros_dict['fat_grams'] / user_goals.fat_grams
-        fat_points = int(fat_points*100 if (0 < fat_points <= 1) else (-fat_points*100))
-
-        carb_points = daily_macros_dict['carb_grams'] / user_goals.carb_grams
-        carb_points = int(carb_points*100 if (0 < carb_points <= 1) else (-carb_points*100))
-
-        points = water_points + protein_points + fat_points + carb_points
-
-        points = points * user.sprint
+        points = day_score(after, user_goals) - day_score(before, user_goals)
 
         return points
 
@@ -230,97 +900,312 @@ def calculate_points(user, user_goals):
         return 10
 
 
-def get_today_macros(user, start_time=None):
+def day_score(daily_macros_dict, user_goals):
+    """
+    Score a day's totals against the user's goals. Each macro scores its percentage of the goal, up to 100,
+    and scores negative if the goal is surpassed.
+    :param daily_macros_dict: A dictionary that maps each of GOAL_PARAM_NAMES -> quantity consumed
+    :param user_goals: The user's goals
+    :return: The day's score, before multiplying by the sprint
+    """
+    # if daily amounts consumed are over the goal limit, points are negative
+    points = 0
+    for macro in nc.GOAL_PARAM_NAMES:
+        ratio = daily_macros_dict[macro] / getattr(user_goals, macro)
+        points += int(ratio*100 if (0 < ratio <= 1) else (-ratio*100))
+
+    return points
+
+
+def entry_macros(entry):
+    """
+    :return: The quantities an entry adds to its day's totals, as stored (ints)
+    """
+    return dict(
+        kilocalories=int(entry.kilocalories),
+        fat_grams=int(entry.fat_grams),
+        carb_grams=int(entry.carb_grams),
+        protein_grams=int(entry.protein_grams),
+        water_ml=int(entry.water_ml or 0)
+    )
+
+
+def get_today_macros(user, start_time=None, include_unflushed=True):
     """
     Get the amount of carbs / protein / fat / water / kcal the user has consumed since the beginning of the day
     :param user: The user we're checking
-    :param start_time: The time from which to start checking for entries. If not specified,
-    defaults to beginning of the current day
+    :param start_time: A date or datetime in the day to check. If not specified, defaults to the current day
+    :param include_unflushed: Whether to count this worker's buffered entries that aren't in the database yet
     :return: A dictionary that maps macro -> quantity of macro consumed
     """
-    # Food/meal entries logged today so far:
-
-    if start_time:
-        start = start_time
-        end = start + timedelta(1)
-    else:
-        start = datetime.now().date()
-        end = start + timedelta(1)
+    # Food/meal entries logged today so far are summed up in the day's DailyTotals row
+    day = start_time if start_time else datetime.now()
+    if isinstance(day, datetime):
+        day = day.date()
+
+    totals = DailyTotals.objects.filter(user_id=user, day=day)\
+        .values("carb_grams", "fat_grams", "protein_grams", "water_ml")\
+        .first()
+
+    if totals is None:
+        # Either nothing was logged that day, or the day predates DailyTotals
+        day_start = datetime.combine(day, time())
+        totals = sum_entries(user, day_start, day_start + timedelta(1))
+
+    if include_unflushed:
+        for entry in unflushed_entries(user.user_id, day):
+            for macro, value in entry_macros(entry).items():
+                if macro in totals:
+                    totals[macro] += value
 
-    # Macros today:
-    carb_g_today = 0
-    fat_g_today = 0
-    protein_g_today = 0
-    water_ml_today = 0
     macros_dict = dict()
+    macros_dict['kilocalories'] = calories_from_macros(totals["carb_grams"], totals["fat_grams"], totals["protein_grams"])
+    macros_dict['carb_grams'] = totals["carb_grams"]
+    macros_dict['fat_grams'] = totals["fat_grams"]
+    macros_dict['protein_grams'] = totals["protein_grams"]
+    macros_dict['water_ml'] = totals["water_ml"]
 
-    today_start = datetime.combine(start, time())
-    today_end = datetime.combine(end, time())
+    return macros_dict
 
-    user_food_list = Entry.objects.filter(user_id=user).filter(time_of_creation__range=[today_start, today_end])
 
-    if user_food_list.exists():
-        for entry in user_food_list:
-            water_ml_today += entry.water_ml
-            carb_g_today += entry.carb_grams
-            fat_g_today += entry.fat_grams
-            protein_g_today += entry.protein_grams
+def sum_entries(user, start, end):
+    """
+    Sum up a user's entries between two times in the database, in a single query.
+    :return: A dictionary that maps carb_grams / fat_grams / protein_grams / water_ml -> total
+    """
+    return Entry.objects.filter(user_id=user, time_of_creation__range=[start, end]).aggregate(
+        carb_grams=Coalesce(Sum("carb_grams"), 0),
+        fat_grams=Coalesce(Sum("fat_grams"), 0),
+        protein_grams=Coalesce(Sum("protein_grams"), 0),
+        water_ml=Coalesce(Sum("water_ml"), 0)
+    )
 
-    macros_dict['kilocalories'] = calories_from_macros(carb_g_today, fat_g_today, protein_g_today)
-    macros_dict['carb_grams'] = carb_g_today
-    macros_dict['fat_grams'] = fat_g_today
-    macros_dict['protein_grams'] = protein_g_today
-    macros_dict['water_ml'] = water_ml_today
 
-    return macros_dict
+def new_entry_id():
+    """
+    :return: A new, unique Entry ID. IDs are compact (13 characters) and sort in the order they were made,
+             so new entries are appended to the end of the primary key index
+    """
+    return entry_id_generator.new_id()
 
 
-def update_points_sprint_checkin(user, user_goals, current_datetime):
+def add_to_daily_totals(user_id, day, entry_count=1, **macros):
     """
-    Rewards the user points, updates their sprint and sets their "last check-in" time.
-    :param user: The user who stats are being updated
-    :param user_goals: The user's current daily goals
-    :param current_datetime: The current date and time (datetime object)
+    Atomically add to a user's totals for a day, creating the day's row if it doesn't exist yet.
+    Should be called inside the transaction that creates the entries being added.
+    :param user_id: The user's ID
+    :param day: A date
+    :param entry_count: The number of entries being added
+    :param macros: The quantities to add, keyed by DailyTotals field name
     """
+    increments = {field: F(field) + value for field, value in macros.items()}
+    increments["entry_count"] = F("entry_count") + entry_count
 
-    # update sprint
-    update_sprint(user)
+    totals = DailyTotals.objects.filter(user_id_id=user_id, day=day)
+    if totals.update(**increments):
+        return
 
     try:
-        # update user's last_checkin
-        setattr(user, "last_checkin", current_datetime)
-    except Exception as e:
-        print(e.__class__.__name__)
-        print(e)
+        with transaction.atomic():
+            DailyTotals.objects.create(
+                totals_id=md5_hash_string(user_id + day.isoformat()),
+                user_id_id=user_id,
+                day=day,
+                entry_count=entry_count,
+                **macros
+            )
+    except IntegrityError:
+        # Another request created the day's row first
+        totals.update(**increments)
+
+
+def log_entry(user, user_goals, **entry_fields):
+    """
+    Create an Entry and update the user's points, sprint and last check-in, all in one transaction (see log_entries()).
+    Takes the same keyword arguments as Entry.objects.create().
+    :return: The new Entry
+    """
+    entry = Entry(**entry_fields)
+    log_entries(user, user_goals, [entry])
+    return entry
 
-    try:
-        # add points to score
-        setattr(user, "points", user.points + calculate_points(user, user_goals))
-    except Exception as e:
-        print(e.__class__.__name__)
-        print(e)
 
-    user.save()
+def log_entries(user, user_goals, entries):
+    """
+    Log a user's entries. With ENTRY_INGESTION_MODE = "buffered" they're journaled and written to the database by
+    the background flusher (see write_journaled_entries()), otherwise they're written before returning.
+    :param user: The user the entries belong to
+    :param user_goals: The user's current daily goals
+    :param entries: A list of unsaved Entry objects, all made on the same day
+    :return: The entries
+    """
+    if getattr(settings, "ENTRY_INGESTION_MODE", "sync") == "buffered":
+        entry_buffer.append([entry_to_record(entry) for entry in entries])
+        user_events.notify(user.user_id)
+        return entries
+
+    return write_entries(user, user_goals, entries)
 
 
-def update_sprint(user):
+def write_entries(user, user_goals, entries):
     """
-    Compares the current time with the time in user.last_checkin. If the last check-in was yesterday, increment the
-    user's current sprint by 1. If the last check-in was before yesterday, reset the user's sprint to 1.
-    Sprint and Streak are the same thing.
+    Insert a user's entries with one bulk_create, add them to the day's DailyTotals and update the user's points,
+    sprint and last check-in once, all in the same transaction, so the totals never disagree with the entries.
+    :param user: The user the entries belong to
+    :param user_goals: The user's current daily goals
+    :param entries: A list of unsaved Entry objects, all made on the same day
+    :return: The entries
     """
+    if not entries:
+        return entries
 
-    try:
-        last_checkin = user.last_checkin
-        current_time = datetime.now()
-        delta = current_time - last_checkin
+    added = dict(kilocalories=0, fat_grams=0, carb_grams=0, protein_grams=0, water_ml=0)
+    for entry in entries:
+        for macro, value in entry_macros(entry).items():
+            added[macro] += value
 
-        setattr(user, "sprint", (user.sprint+1 if 2 < delta.days < 1 else 1))
-        user.save()
-    except Exception as e:
-        print("UPDATING SPRINT IS BROKEN")
-        print(e.__class__.__name__)
-        print(e)
+    last_time = max(entry.time_of_creation for entry in entries)
+
+    with transaction.atomic():
+        Entry.objects.bulk_create(entries)
+        add_to_daily_totals(user.user_id, last_time.date(), entry_count=len(entries), **added)
+        update_points_sprint_checkin(user, user_goals, last_time, entries)
+        transaction.on_commit(lambda: notify_user_changed(user.user_id))
+
+    return entries
+
+
+def entry_to_record(entry):
+    """
+    :return: An unsaved Entry as a JSON serializable dictionary, to be journaled
+    """
+    return dict(
+        entry_id=entry.entry_id,
+        user_id=entry.user_id_id,
+        time_of_creation=entry.time_of_creation.isoformat(),
+        entry_name=entry.entry_name,
+        is_meal=entry.is_meal,
+        kilocalories=entry.kilocalories,
+        fat_grams=entry.fat_grams,
+        carb_grams=entry.carb_grams,
+        protein_grams=entry.protein_grams,
+        water_ml=entry.water_ml,
+        is_water=entry.is_water
+    )
+
+
+def entry_from_record(record):
+    """
+    :return: The unsaved Entry a journaled record was made from
+    """
+    fields = dict(record)
+    fields["user_id_id"] = fields.pop("user_id")
+    # isoformat() leaves out the microseconds when they're 0
+    time_format = "%Y-%m-%dT%H:%M:%S.%f" if "." in fields["time_of_creation"] else "%Y-%m-%dT%H:%M:%S"
+    fields["time_of_creation"] = datetime.strptime(fields["time_of_creation"], time_format)
+    return Entry(**fields)
+
+
+def unflushed_entries(user_id, day):
+    """
+    :return: The unsaved Entries this worker has journaled for a user on a day, that aren't in the database yet.
+             Entries buffered by other workers aren't visible until they're flushed (within ENTRY_FLUSH_INTERVAL)
+    """
+    prefix = day.isoformat()
+    return [entry_from_record(record) for record in entry_buffer.unflushed()
+            if record["user_id"] == user_id and record["time_of_creation"].startswith(prefix)]
+
+
+def write_journaled_entries(records, committed):
+    """
+    Write journaled entries to the database, grouped into one write_entries() per user and day, in the order they
+    were logged. Records whose entry is already in the database are skipped, so replaying a journal after a crash
+    never counts an entry (or its points) twice.
+    Called by entry_buffer's flusher thread.
+    :param records: A list of dictionaries made by entry_to_record()
+    :param committed: Called with the records of each group as soon as it's committed (and with the skipped
+                      records), so they stop being counted as unflushed while the rest are written
+    """
+    close_old_connections()
+
+    existing = set(Entry.objects.filter(entry_id__in=[record["entry_id"] for record in records])
+                   .values_list("entry_id", flat=True))
+
+    skipped = []
+    batches = dict()
+    for record in records:
+        if record["entry_id"] in existing:
+            skipped.append(record)
+            continue
+        existing.add(record["entry_id"])
+        entry = entry_from_record(record)
+        batch = batches.setdefault((entry.user_id_id, entry.time_of_creation.date()), ([], []))
+        batch[0].append(record)
+        batch[1].append(entry)
+    committed(skipped)
+
+    for (user_id, day), (batch_records, entries) in batches.items():
+        try:
+            user_goals = Goals.objects.select_related("user_id").get(user_id=user_id)
+        except ObjectDoesNotExist:
+            print("Dropping {} journaled entries of deleted user {}".format(len(entries), user_id))
+            committed(batch_records)
+            continue
+        write_entries(user_goals.user_id, user_goals, entries)
+        committed(batch_records)
+
+
+def recover_entry_journals(sender, **kwargs):
+    """
+    Signal receiver that replays journals left behind by crashed workers (in the background) the first time a
+    worker handles a request, whatever ENTRY_INGESTION_MODE is, since they may predate a switch back to "sync".
+    """
+    entry_buffer.start_recovery()
+
+
+request_started.connect(recover_entry_journals, dispatch_uid="recover_entry_journals")
+
+
+def update_points_sprint_checkin(user, user_goals, current_datetime, entries):
+    """
+    Rewards the user points, updates their sprint and sets their "last check-in" time. Also bumps their
+    data_version, since their entries changed.
+
+    All of them are written in a single UPDATE built from F() expressions, so the new sprint and points are computed
+    from the row's current values in the database. Concurrent logs for the same user can't overwrite each other.
+    :param user: The user who stats are being updated
+    :param user_goals: The user's current daily goals
+    :param current_datetime: The current date and time (datetime object)
+    :param entries: The list of Entries that were just logged
+    """
+    sprint = sprint_expression(current_datetime)
+
+    Users.objects.filter(user_id=user.user_id).update(
+        sprint=sprint,
+        points=F("points") + calculate_points(user, user_goals, entries) * sprint,
+        last_checkin=current_datetime,
+        data_version=F("data_version") + 1
+    )
+
+    invalidate_cached_user(user.user_id)
+
+
+def sprint_expression(current_datetime):
+    """
+    Build an expression for a user's sprint after checking in at current_datetime, based on their last_checkin.
+    If the last check-in was yesterday, the sprint goes up by 1. If it was today, the sprint stays the same.
+    If it was before yesterday, the sprint is reset to 1.
+    Sprint and Streak are the same thing.
+    """
+    today_start = datetime.combine(current_datetime.date(), time())
+    yesterday_start = today_start - timedelta(1)
+
+    return Case(
+        When(last_checkin__gte=today_start, then=F("sprint")),
+        When(last_checkin__gte=yesterday_start, then=F("sprint") + 1),
+        default=Value(1),
+        output_field=IntegerField()
+    )
 
 
 def build_food_req_string(food_name):
@@ -329,8 +1214,7 @@ def build_food_req_string(food_name):
     :param food_name: The name of the food we're searching for
     :return: The URL to set the GET request to
     """
-    reqstr = nc.FOOD_BASE_URL + food_name + nc.ALL_ATTRS + nc.LIMIT_ONE
-    return reqstr
+    return nutritics_client.build_food_url(food_name)
 
 
 def md5_hash_string(string):
@@ -388,22 +1272,25 @@ def get_relevant_user_data(client_name):
         - User's current streak
         - A list of foods that the user has consumed today (probably a queryset object or something)
 
+    Costs two queries however many entries the user has: one for the user and their goals, and one for the day's
+    entries, from which the totals and the meals are both worked out.
+
     :param client_name: The client's monstrous username
     :return: Dict of info about the user
     """
 
     try:
-        # Get the user from the database
-        user = Users.objects.get(name=client_name)
+        # Get the user and their goals from the database, together
+        user_goals = Goals.objects.select_related("user_id").get(user_id__name=client_name)
+        user = user_goals.user_id
+        remember_user_version(client_name, user.user_id, user.data_version)
 
     except ObjectDoesNotExist:
         # Catch the exception and pass it along, handle in parent
         raise ObjectDoesNotExist
 
     try:
-        user_goals = Goals.objects.get(user_id=user.user_id)
         user_data = dict()
-        today_info = get_today_macros(user)
 
         # Add goals and other stats to user, create space for logged entries
         user_data["username"] = user.name
@@ -414,6 +1301,32 @@ def get_relevant_user_data(client_name):
         user_data["lunch_foods"] = []
         user_data["dinner_foods"] = []
 
+        # Sum up today's macros and sort today's foods into meals in one pass over the day's entries
+        # (fetched in one query, plus any of this worker's entries that aren't flushed yet)
+        start = datetime.now().date()
+        today_start = datetime.combine(start, time())
+        today_end = today_start + timedelta(1)
+
+        today_entries = list(Entry.objects.filter(user_id=user)
+                             .filter(time_of_creation__range=[today_start, today_end])
+                             .values_list("entry_name", "time_of_creation", "is_water",
+                                          "carb_grams", "fat_grams", "protein_grams", "water_ml"))
+        today_entries += [(entry.entry_name, entry.time_of_creation, entry.is_water, int(entry.carb_grams),
+                           int(entry.fat_grams), int(entry.protein_grams), int(entry.water_ml or 0))
+                          for entry in unflushed_entries(user.user_id, start)]
+
+        today_info = dict(carb_grams=0, fat_grams=0, protein_grams=0, water_ml=0)
+        for entry_name, time_of_creation, is_water, carb_grams, fat_grams, protein_grams, water_ml in today_entries:
+            today_info["carb_grams"] += carb_grams
+            today_info["fat_grams"] += fat_grams
+            today_info["protein_grams"] += protein_grams
+            today_info["water_ml"] += water_ml or 0
+            if not is_water:
+                user_data[which_meal(time_of_creation)].append(entry_name)
+
+        today_info["kilocalories"] = calories_from_macros(
+            today_info["carb_grams"], today_info["fat_grams"], today_info["protein_grams"])
+
         # Add macro quanities, goals and percentages
         user_data["curr_user_carbs"] = today_info["carb_grams"]
         user_data["user_carbs_goal"] = user_goals.carb_grams
@@ -435,22 +1348,6 @@ def get_relevant_user_data(client_name):
         user_data["user_water_goal"] = user_goals.water_ml
         user_data["user_water_percentage"] = int((today_info["water_ml"] / user_goals.water_ml) * 100)
 
-        if today_info:
-            # Add meals and food consumed today is any exist
-            start = datetime.now().date()
-            end = start + timedelta(1)
-
-            today_start = datetime.combine(start, time())
-            today_end = datetime.combine(end, time())
-
-            user_food_list = Entry.objects.filter(user_id=user)\
-                .filter(is_water=False)\
-                .filter(time_of_creation__range=[today_start, today_end])
-
-            if user_food_list.exists():
-                for entry in user_food_list:
-                    user_data[which_meal(entry.time_of_creation)].append(entry.entry_name)
-
         return user_data
 
     except Exception as e:
@@ -0,0 +1,266 @@
+import atexit
+import errno
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+"""
+Write-behind buffering: records are appended to a durable local journal and acknowledged straight away, and
+a background thread writes them to the database in batches.
+"""
+
+
+class WriteBehindBuffer:
+    """
+    Buffers records (JSON serializable dicts) in memory and in an append-only journal file, and hands them to
+    flush_fn in batches from a background thread.
+
+    Each process has its own journal, which it holds an flock() on while it's alive. When a batch is flushed, the
+    journal is first renamed out of the way (so new records go to a fresh journal), and the renamed file is
+    deleted once flush_fn returns. On start up (see start_recovery()), journals that no live process holds a lock on
+    were left behind by a crash, so they're replayed through flush_fn. flush_fn must therefore be idempotent.
+
+    Journals only survive as long as the disk they're on. A worker crash loses nothing, but on Heroku the dyno's
+    disk is wiped when the dyno restarts, so records that weren't flushed by then are lost.
+    """
+    def __init__(self, directory, flush_fn, flush_interval=1.0, flush_size=200):
+        """
+        :param directory: The directory journals are kept in. Must be on a local disk shared by all workers
+        :param flush_fn: Called with a list of records, and a function to call with the records that are committed
+                         as soon as they are (it may write them in several transactions)
+        :param flush_interval: The longest time (seconds) a record waits before it's flushed
+        :param flush_size: Flush as soon as this many records are waiting
+        """
+        self.directory = directory
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._journal = None
+        self._journal_path = None
+        self._rotations = 0
+        self._pending = []
+        self._flushing = []
+        self._unremoved = []
+        self._failures = 0
+        self._retry_at = 0.0
+        self._recovered_pid = None
+
+    def _start(self):
+        """
+        Open this process' journal and start the flusher thread (and the replay of orphaned journals, if it
+        hasn't been started already).
+        Done lazily on first use, since with gunicorn --preload the module is imported before the workers fork.
+        Must be called with self._lock held.
+        """
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._pending = []
+        self._flushing = []
+        self._unremoved = []
+        self._failures = 0
+        self._retry_at = 0.0
+        os.makedirs(self.directory, exist_ok=True)
+
+        # A journal left by a dead process with the same (reused) pid is moved aside for recover(), not appended to
+        self._journal_path = os.path.join(self.directory, "entries-{}.journal".format(self._pid))
+        if os.path.exists(self._journal_path):
+            os.rename(self._journal_path, "{}.orphan-{}".format(self._journal_path, int(time.time())))
+        self._journal = self._open_journal()
+
+        # Replaying orphaned journals writes to the database, so it's done in the background, not by the request
+        self._start_recovery()
+        threading.Thread(target=self._run, name="write-behind-flusher", daemon=True).start()
+        atexit.register(self.flush, True)
+
+    def _open_journal(self):
+        """
+        Create a fresh, locked journal at self._journal_path. It's locked before it's given its real name, so
+        recover() in another process never mistakes it for an orphan.
+        """
+        tmp_path = "{}.{}.tmp".format(self._journal_path, self._rotations)
+        journal = open(tmp_path, "a")
+        fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+        os.rename(tmp_path, self._journal_path)
+        return journal
+
+    def append(self, records):
+        """
+        Durably journal records and queue them to be flushed. Returns once they're on disk.
+        :param records: A list of JSON serializable dicts
+        """
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+
+        with self._lock:
+            self._start()
+            self._journal.write(lines)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._pending.extend(records)
+            waiting = len(self._pending)
+
+        if waiting >= self.flush_size:
+            self._wakeup.set()
+
+    def unflushed(self):
+        """
+        :return: A list of this process' records that haven't been written to the database yet
+        """
+        with self._lock:
+            return self._flushing + self._pending
+
+    def _committed(self, records):
+        """
+        Passed to flush_fn, which calls it as soon as some of the batch's records are committed, so unflushed()
+        stops counting them straight away (and a failure later in the batch doesn't retry them).
+        """
+        done = set(id(record) for record in records)
+        with self._lock:
+            self._flushing = [record for record in self._flushing if id(record) not in done]
+
+    def flush(self, force=False):
+        """
+        Write every record waiting in this process to the database.
+
+        If flush_fn fails, the records it didn't commit stay in the rotated journal and are retried on their own
+        by the next flushes, backing off exponentially (up to a minute), so an outage doesn't rotate a new journal
+        every flush_interval. Records appended meanwhile wait in the current journal until the retry succeeds.
+        :param force: Retry a failed batch now, even if it's backing off
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._pid != os.getpid():
+                    return
+
+                if self._unremoved:
+                    # A previous flush failed: retry what's left of its batch
+                    if not force and time.monotonic() < self._retry_at:
+                        return
+                    batch = list(self._flushing)
+                else:
+                    if not self._pending:
+                        return
+
+                    batch = self._flushing = self._pending
+                    self._pending = []
+
+                    # Move the journal out of the way, so records appended while flushing go to a new one
+                    self._rotations += 1
+                    flushing_path = "{}.{}.flushing".format(self._journal_path, self._rotations)
+                    os.rename(self._journal_path, flushing_path)
+                    # Keep the old journal open (and locked) until its records are in the database
+                    self._unremoved.append((self._journal, flushing_path))
+                    self._journal = self._open_journal()
+
+            try:
+                if batch:
+                    self.flush_fn(batch, self._committed)
+            except Exception as e:
+                with self._lock:
+                    self._failures += 1
+                    delay = min(60.0, self.flush_interval * 2 ** self._failures)
+                    self._retry_at = time.monotonic() + delay
+                    waiting = len(self._flushing)
+                print("Write-behind flush failed, retrying {} records in {:.1f}s".format(waiting, delay))
+                print(e.__class__.__name__)
+                print(e)
+                return
+
+            with self._lock:
+                self._flushing = []
+                self._failures = 0
+
+            for journal, path in self._unremoved:
+                os.remove(path)
+                journal.close()
+            self._unremoved = []
+
+    def start_recovery(self):
+        """
+        Replay orphaned journals (see recover()) in a background thread, once per process.
+        """
+        with self._lock:
+            self._start_recovery()
+
+    def _start_recovery(self):
+        """
+        Must be called with self._lock held.
+        """
+        if self._recovered_pid == os.getpid():
+            return
+        self._recovered_pid = os.getpid()
+        threading.Thread(target=self.recover, name="write-behind-recovery", daemon=True).start()
+
+    def recover(self):
+        """
+        Replay journals left behind by processes that died before flushing them.
+        """
+        for path in sorted(glob.glob(os.path.join(self.directory, "entries-*.journal*"))):
+            if path.endswith(".tmp"):
+                continue
+
+            try:
+                f = open(path, "r")
+            except FileNotFoundError:
+                continue
+
+            try:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EACCES):
+                        # A live process owns this journal
+                        continue
+                    raise
+
+                try:
+                    if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                        continue
+                except FileNotFoundError:
+                    # Another process replayed and removed it while we waited
+                    continue
+
+                records = self._read_journal(f, path)
+                if records:
+                    print("Replaying {} journaled records from {}".format(len(records), path))
+                    self.flush_fn(records, lambda committed: None)
+                os.remove(path)
+            except Exception as e:
+                print("Replaying journal {} failed".format(path))
+                print(e.__class__.__name__)
+                print(e)
+            finally:
+                f.close()
+
+    def _read_journal(self, f, path):
+        """
+        :return: The records in a journal. A crash in the middle of append() leaves a cut off last line, which is
+                 dropped (its request never got a response), as is any other line that can't be decoded
+        """
+        records = []
+        for line_num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if not line.endswith("\n"):
+                print("Dropping the incomplete last line of journal {}".format(path))
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print("Dropping undecodable line {} of journal {}".format(line_num, path))
+        return records
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
@@ -2,6 +2,7 @@ from django.conf.urls import url
 from webinterface import views
 
 urlpatterns = [
+    url(r'^(?P<client_name>.+?)/stream/$', views.insights_stream),
     url(r'^(?P<client_name>.+?)/$', views.insights),
 
 ]
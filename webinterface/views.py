@@ -1,26 +1,71 @@
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
 from django.shortcuts import render
+from django.template.loader import get_template
 
-from django.http import HttpResponse
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import status
+import threading
+import time as monotonic_time
 
-import pprint
-
+from utility.jsonencode import encode_json
+from utility.lrucache import LRUCache
 from utility.utils import *
 
+# Rendered insights pages, keyed by their ETag. A page's ETag changes whenever anything shown on it does
+insights_page_cache = LRUCache(
+    max_size=getattr(settings, "INSIGHTS_CACHE_MAX_SIZE", 256),
+    ttl=None
+)
 
-def insights(request, client_name):
+_template_version = None
+
+# Each open stream holds one of the worker's threads, so only this many are streamed at once, and the rest of the
+# threads are kept for REST requests. Pages that don't get a slot poll instead (see insights_events())
+stream_slots = threading.BoundedSemaphore(getattr(settings, "INSIGHTS_MAX_STREAMS", 2))
 
+
+def insights(request, client_name):
+    """
+    Render a user's insights page. Pages are cached, and sent with a strong ETag: a request whose If-None-Match
+    matches the current version of the page gets a 304, without any database work if the user's data_version
+    is cached (see get_user_version()), and one query if it isn't. Rendering a page costs the two queries of
+    get_relevant_user_data().
+    """
     try:
         # user_data = get_relevant_user_data(client_name)
         if client_name == 'democlient':
             data = get_dummy_data_for_html("AngryAnnoyedAardvark")
-        else:
+            return render(request, "insights/insights.html", data)
+
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+
+        data = None
+        if if_none_match is None and get_user_version(client_name, cached_only=True) is None:
+            # The page will be rendered, and its data includes the user's data_version, so fetching the data first
+            # saves a query for the version. A revalidation only needs the version, so it's looked up on its own
             data = get_relevant_user_data(client_name)
 
-        pp = pprint.PrettyPrinter(indent=2)
-        pp.pprint(data)
+        etag = insights_etag(*get_user_version(client_name))
+
+        if if_none_match is not None and etag in parse_etags(if_none_match):
+            response = HttpResponseNotModified()
+        else:
+            content = insights_page_cache.get(etag)
+            if content is None:
+                if data is None:
+                    data = get_relevant_user_data(client_name)
+                data["live_updates"] = True
+                content = render(request, "insights/insights.html", data).content
+                insights_page_cache.set(etag, content)
+            response = HttpResponse(content)
 
-        return render(request, "insights/insights.html", data)
+        response["ETag"] = etag
+        # Browsers may keep the page, but have to check it's still current before showing it again
+        response["Cache-Control"] = "private, no-cache"
+        return response
 
     except ObjectDoesNotExist:
         # TODO: The user doesn't have an account, so render an error page telling them to use the app at least once
@@ -28,6 +73,119 @@ def insights(request, client_name):
         return HttpResponse(status=status.HTTP_404_NOT_FOUND)
 
 
+def insights_stream(request, client_name):
+    """
+    Stream changes to a user's insights page as server-sent events, so an open page updates without reloading.
+
+    The first event ("snapshot") holds everything on the page. After that, whenever anything on the page changes,
+    an "update" event holds just the fields that changed, e.g.
+    {
+        "user_score": 64,
+        "curr_user_water": 750,
+        "user_water_percentage": 21,
+        "lunch_foods": ["Pizza", "Apple"]
+    }
+    """
+    try:
+        user_id, data_version = get_user_version(client_name)
+    except ObjectDoesNotExist:
+        return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+
+    response = StreamingHttpResponse(insights_events(client_name, user_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx style proxies from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def insights_events(client_name, user_id):
+    """
+    Generate the server-sent events for insights_stream().
+
+    While nothing changes, the stream's thread sleeps in user_events.wait(). Logging through this worker wakes it up
+    immediately. Changes made by other workers are noticed by checking the user's (cached) data_version every
+    INSIGHTS_STREAM_POLL seconds. The database connection is closed between checks, so an idle stream holds none.
+
+    At most INSIGHTS_MAX_STREAMS streams are open per worker. Past that, the stream just sends the snapshot and
+    ends, telling the browser to reconnect in INSIGHTS_STREAM_BUSY_RETRY seconds, so the page polls instead.
+    """
+    if not stream_slots.acquire(blocking=False):
+        # Every stream slot is taken. Send the page as it is now, and have the browser check back later
+        data = get_relevant_user_data(client_name)
+        connection.close()
+        yield "retry: {}\n".format(int(getattr(settings, "INSIGHTS_STREAM_BUSY_RETRY", 30) * 1000))
+        yield server_sent_event("snapshot", data)
+        return
+
+    try:
+        poll = getattr(settings, "INSIGHTS_STREAM_POLL", 5)
+        heartbeat = getattr(settings, "INSIGHTS_STREAM_HEARTBEAT", 15)
+        deadline = monotonic_time.monotonic() + getattr(settings, "INSIGHTS_STREAM_MAX_DURATION", 300)
+
+        seen = user_events.current(user_id)
+        etag = insights_etag(*get_user_version(client_name))
+        data = get_relevant_user_data(client_name)
+        connection.close()
+
+        # Browsers reconnect this many milliseconds after the stream ends
+        yield "retry: 1000\n"
+        yield server_sent_event("snapshot", data)
+        last_sent = monotonic_time.monotonic()
+
+        while monotonic_time.monotonic() < deadline:
+            seen = user_events.wait(user_id, seen, poll)
+
+            try:
+                new_etag = insights_etag(*get_user_version(client_name))
+                if new_etag != etag:
+                    etag = new_etag
+                    new_data = get_relevant_user_data(client_name)
+                    changed = {key: value for key, value in new_data.items() if data.get(key) != value}
+                    data = new_data
+                    if changed:
+                        yield server_sent_event("update", changed)
+                        last_sent = monotonic_time.monotonic()
+            except ObjectDoesNotExist:
+                return
+            finally:
+                connection.close()
+
+            if monotonic_time.monotonic() - last_sent >= heartbeat:
+                # A comment line, which keeps proxies from timing out the idle connection
+                yield ": keepalive\n\n"
+                last_sent = monotonic_time.monotonic()
+    finally:
+        stream_slots.release()
+
+
+def server_sent_event(event, data):
+    """
+    :return: data, encoded as a JSON server-sent event of type event
+    """
+    return "event: {}\ndata: {}\n\n".format(event, encode_json(data).decode("utf-8"))
+
+
+def insights_etag(user_id, data_version):
+    """
+    Build the ETag of a user's insights page from everything it depends on: the user's data_version, the day
+    (totals start again from 0 every day), the worker's entries for the user that aren't flushed yet (see
+    log_entries()), the template and the static files it links to.
+    :return: A quoted, strong ETag
+    """
+    global _template_version
+
+    if _template_version is None:
+        # The page links to static files by their hashed names, so it changes whenever they do
+        static_names = sorted(getattr(staticfiles_storage, "hashed_files", dict()).items())
+        _template_version = md5_hash_string(get_template("insights/insights.html").template.source + str(static_names))
+
+    today = datetime.now().date()
+    unflushed = len(unflushed_entries(user_id, today))
+
+    return quote_etag(md5_hash_string("{}:{}:{}:{}:{}".format(
+        user_id, data_version, today.isoformat(), unflushed, _template_version)))
+
+
 ###################
 # TESTING ONLY
 ###################